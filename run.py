@@ -2,23 +2,41 @@
 Usage:
 python3 run.py [scint_number] [command] [command_args]
 
-For all scints, scint_number = 'all', otherwise 1-4
+For all scints, scint_number = 'all', otherwise a channel number from the discovered
+channel map (see utils.discovery; 1-4 with the single USB-COM485 Plus4 hub)
 
 Runs scintillator code.
 Uses a command to control all scints simultaneously, or a single scint.
+If the control daemon (run_daemon.py) is running, the command is forwarded to it,
+otherwise the serial ports are opened directly.
 """
 
 import sys
-from utils.scintillators import Scintillators
-from utils.scintillator import Scintillator
+from utils.client import daemonAvailable, sendRequest
 
-# for interactive
-import code
+def runWithDaemon(scint_num, cmd, cmd_args):
+    """Forward the command to the daemon and print its reply, returns the exit code"""
+    reply = sendRequest(scint_num, cmd, cmd_args)
+    if not reply["ok"]:
+        print(reply["output"])
+        return 1
+    if reply["output"]:
+        print(reply["output"])
+    channels = range(1, len(reply["results"])+1) if scint_num == 'all' else [int(scint_num)]
+    for channel, result in zip(channels, reply["results"]):
+        if str(channel) in reply["errors"]:
+            print(f'Scintillator {channel} raised an error: {reply["errors"][str(channel)]}')
+            continue
+        if result is not None:
+            print(result)
+        print(f"Command successfully sent to Scintillator {channel}")
+    return 1 if reply["errors"] else 0
     
 if __name__ == "__main__":
     # Check if an argument is provided
     if len(sys.argv) < 3:
-        help_msg = "Run a command for all scints or a single scint.\n\nUsage:\npython3 run.py [scint_number] [command] [command args]\n\nFor all scints, scint_number = 'all', otherwise 1-4\n\nList of commands:\n-----------------\nIf all scints:\n    printStatus()\n\tPrint a table sumarizing the status of all scintillators\n\nAll or Single scint:"+Scintillator.__doc__.split('-------')[-1]
+        from utils.scintillator import Scintillator
+        help_msg = "Run a command for all scints or a single scint.\n\nUsage:\npython3 run.py [scint_number] [command] [command args]\n\nFor all scints, scint_number = 'all', otherwise a channel number\n\nList of commands:\n-----------------\nIf all scints:\n    printStatus()\n\tPrint a table sumarizing the status of all scintillators\n\nAll or Single scint:"+Scintillator.__doc__.split('-------')[-1]
         print(help_msg)
         sys.exit(1)
 
@@ -26,11 +44,25 @@ if __name__ == "__main__":
     cmd = sys.argv[2]
     cmd_args = sys.argv[3:]
 
+    if daemonAvailable():
+        try:
+            sys.exit(runWithDaemon(scint_num, cmd, cmd_args))
+        except OSError as e:
+            print(f"Daemon not reachable ({e}), opening serial ports directly")
+
+    from utils.scintillators import Scintillators
+    from utils.scintillator import Scintillator
+
     if scint_num == 'all':
         # do cmd with all scints
-        scint = Scintillators(number_of_scints=4)
+        scint = Scintillators.discover()
         scint.runMethod(cmd, *cmd_args)
-    elif int(scint_num) in [1,2,3,4]:
+        for channel in range(1, scint.count+1):
+            if channel in scint.errors:
+                print(f'Scintillator {channel} raised an error: {scint.errors[channel]}')
+            else:
+                print(f"Command successfully sent to Scintillator {channel}")
+    elif int(scint_num) >= 1:
         # do cmd with scint int(scint_num)
         scint = Scintillator(scint_number=int(scint_num))
         try:
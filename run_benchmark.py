@@ -0,0 +1,34 @@
+"""
+Usage:
+python3 run_benchmark.py [--ports PORT ...] [--change-hv] [--channels 1 2 4] [--repeats N] [--duration S] [--output FILE]
+
+Measures per-command latency percentiles, status sweeps per second vs. channel count and CPU time
+per command for Scintillator and Scintillators, and writes the results as JSON.
+Without --ports the benchmarks run against simulated channels (utils.simulator).
+On real channels only read-only commands are timed, unless --change-hv is given: it times HV_Set
+(to 50 V on every channel), HV_On and HV_Off too.
+"""
+
+import argparse
+import json
+from utils.benchmark import runBenchmarks
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scintillator command latency and throughput benchmarks")
+    parser.add_argument("--ports", nargs="+", default=None, help="serial ports of real channels, default: simulated channels")
+    parser.add_argument("--change-hv", action="store_true",
+                        help="with --ports, also time HV_Set (50 V on all channels), HV_On and HV_Off")
+    parser.add_argument("--channels", nargs="+", type=int, default=[1, 2, 4], help="channel counts for status sweeps")
+    parser.add_argument("--repeats", type=int, default=20, help="calls per timed command")
+    parser.add_argument("--duration", type=float, default=2., help="seconds of status sweeps per channel count")
+    parser.add_argument("--pacing", type=float, default=None, help="inter-character write delay in seconds")
+    parser.add_argument("--output", default=None, help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = runBenchmarks(channel_counts=args.channels, serial_ports=args.ports, repeats=args.repeats,
+                            duration=args.duration, change_hv=True if args.change_hv else None, pacing=args.pacing)
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,29 @@
+"""
+Usage:
+python3 run_daemon.py [<number of scint channels> [serial ports ...]]
+
+Runs the scintillator control daemon, which keeps the serial ports open and serves commands
+from run.py over a Unix socket (path from $SCINT_SOCKET, default /tmp/scint.sock).
+"""
+
+import sys
+from utils.client import SOCKET_PATH
+from utils.daemon import ScintillatorDaemon
+
+if __name__ == "__main__":
+    # Without arguments, serve all channels of the discovered hubs
+    if len(sys.argv) < 2:
+        daemon = ScintillatorDaemon(discover=True)
+    else:
+        try:
+            range_value = int(sys.argv[1])
+        except ValueError:
+            print("Invalid number of channels. Please provide a valid integer.")
+            sys.exit(1)
+        serial_ports = sys.argv[2:] or None
+        daemon = ScintillatorDaemon(number_of_scints=range_value, serial_ports=serial_ports)
+    print(f"Serving {daemon.scints.count} scintillator channels on {SOCKET_PATH}")
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
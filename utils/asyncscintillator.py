@@ -0,0 +1,328 @@
+"""This file defines asyncio versions of the Scintillator and Scintillators classes"""
+import asyncio
+from contextlib import asynccontextmanager
+from serial import SerialException
+from utils import breaker
+from utils import conversions
+from utils import frames
+from utils import portpool
+from utils import scheduler
+from utils.scintillator import Scintillator
+from utils.scintillators import Scintillators
+
+class AsyncScintillator(Scintillator):
+    """
+    AsyncScintillator
+
+    Coroutine version of Scintillator for use from an asyncio event loop. The serial port is used
+    in non-blocking mode and the event loop is woken by the port's file descriptor when bytes arrive,
+    so many channels can be served from one loop without threads. Command building and reply parsing
+    are shared with Scintillator. Commands take their turn on the port from the same PortScheduler as
+    Scintillator, in the priority class active when they start, and are refused while the circuit
+    breaker is open. Only the text transport is supported.
+
+    Parameters
+    ----------
+    Same as Scintillator, except transport, which is always "text", and status_max_age, as the
+    status is always queried.
+
+    Attributes
+    ----------
+    Same as Scintillator.
+
+    Methods
+    -------
+    await sendCommand(command, terminator=None)
+        Send a command over serial interface and read the reply until it is complete
+    getHVStatus(status)
+        Get HV status returned from HPO command (whose result must be used as input)
+    await getStatus()
+        Return a dictionary of status values
+    await getStatusRecord()
+        Return the status as a StatusRecord (see utils.status)
+    await printStatus()
+        Print the status elements
+    await HV_On()
+        Turn on high voltage
+    await HV_Off()
+        Turn off high voltage
+    await HV_Set(voltage)
+        Set high voltage to given voltage value. Must be between 40 and 60 V
+    await getMCStatus()
+        Return status of the microcontroller
+    await getOutputVoltage(), await getOutputCurrent(), await getTemperature(), await getChipStatus()
+        Return a single quantity as Scintillator does
+    await getTemperatureCorrectionFactor(), await setTemperatureCorrectionFactor(dT1_s, dT2_s, dT1, dT2, tb)
+        Read or set the temperature correction settings
+    await batch(commands, pipelined=False)
+        Run several commands as Scintillator.batch does
+
+    """
+
+    def __init__(self, scint_number = 1, serial_port = None, baud_rate = 9600, timeout = 1, quiet_time = .05, pacing = None,
+                 parity = None, port_scheduler = None, circuit_breaker = None):
+        super().__init__(scint_number=scint_number, serial_port=serial_port, baud_rate=baud_rate,
+                         timeout=timeout, quiet_time=quiet_time, pacing=pacing,
+                         transport="text", parity=parity, port_scheduler=port_scheduler, circuit_breaker=circuit_breaker)
+        self._lock = asyncio.Lock()
+
+    @property
+    def help(self):
+        return AsyncScintillator.__doc__
+
+    async def sendCommand(self, command, terminator=None):
+        #Same reply framing as Scintillator.sendCommand, waiting on the event loop between reads.
+        return await self._query(command, terminator, bytes)
+
+    def sendFrame(self, cmd, data=b""):
+        raise RuntimeError("AsyncScintillator only supports the text transport")
+
+    async def batch(self, commands, pipelined=False):
+        """Coroutine version of Scintillator.batch"""
+        commands = [(command,) if isinstance(command, str) else tuple(command) for command in commands]
+        if not pipelined:
+            results = []
+            for name, *args in commands:
+                try:
+                    results.append(await getattr(self, self._batchMethod(name))(*args))
+                except Exception as e:
+                    results.append(e)
+            return results
+
+        results, pending = self._prepareBatch(commands)
+        if not pending:
+            return results
+        replies = await self._query(self._batchLine(pending), Scintillator._frameEnd, self._splitFrames, count=len(pending),
+                                    exempt=self._batchExempt(pending))
+        return self._finishBatch(results, pending, replies)
+
+    async def getStatus(self):
+        """Get the status dict of HV chip--voltages, temperatures, configuration settings"""
+        return (await self.getStatusRecord()).asDict()
+
+    async def getStatusRecord(self):
+        """Get the status as a StatusRecord (see utils.status)"""
+        try:
+            return await self._query("pmt HPO\r", Scintillator._frameEnd, self._parseStatus)
+        except (TimeoutError, SerialException):
+            return self._recordFromData(None)
+        except breaker.ChannelUnavailable:
+            return self._recordFromData(None, "unavailable")
+
+    async def printStatus(self):
+        """Give a nice print message outlining the status"""
+        print(self._formatStatus(await self.getStatus()))
+
+    async def HV_On(self):
+        #Turns HV on, raises unless the HV chip acknowledged it
+        await self._queryValues("HON")
+        return "High Voltage On!"
+
+    async def HV_Off(self):
+        #Turns off HV, raises unless the HV chip acknowledged it
+        await self._queryValues("HOF")
+        return "High Voltage Off!"
+
+    async def HV_Set(self, voltage):
+        #Sets the High Voltage to any value between 40 and 60--the range that the MC accepts
+        await self._queryValues("HBV", [self._hvSetCode(voltage)])
+        self.HV = voltage
+        return "HV set to "+ str(voltage) +"V"
+
+    async def getMCStatus(self):
+        return await self._query("status\r", None, self._parseMCStatus)
+
+    async def getOutputVoltage(self):
+        return conversions.fromCode((await self._queryValues("HGV"))[0], "voltage")
+
+    async def getOutputCurrent(self):
+        return conversions.fromCode((await self._queryValues("HGC"))[0], "current")
+
+    async def getTemperature(self):
+        return conversions.fromCode((await self._queryValues("HGT"))[0], "temperature")
+
+    async def getChipStatus(self):
+        return self.getHVStatus((await self._queryValues("HGS"))[0])
+
+    async def getTemperatureCorrectionFactor(self):
+        return self._temperatureCorrectionFromData(await self._queryValues("HRT"))
+
+    async def setTemperatureCorrectionFactor(self, dT1_s, dT2_s, dT1, dT2, tb):
+        vb = (await self.getTemperatureCorrectionFactor()).get("Vb")
+        await self._queryValues("HST", self._temperatureCorrectionCodes(dT1_s, dT2_s, dT1, dT2, tb, vb))
+        return "Temperature correction factors set"
+
+    # -- private methods --
+
+    @asynccontextmanager
+    async def _portTurn(self, exempt=False):
+        #Coroutine version of Scintillator._portTurn. The scheduler turn is waited for on the event
+        #loop, in the priority class of the calling code, so no thread is blocked while waiting.
+        if not exempt and scheduler.currentPriority()[0] != "safety" and not self.circuit_breaker.allow():
+            raise breaker.ChannelUnavailable(self.scint_channel, self.circuit_breaker.retry_in)
+        async with self.port_scheduler.asyncTurn(self.scint_channel):
+            try:
+                self._ser = portpool.POOL.open(self.port, self.baud_rate, self.timeout, self.parity)
+                yield
+            except frames.CommandParsingException:
+                self.circuit_breaker.failure()
+                raise
+            except OSError as e:
+                self.circuit_breaker.failure()
+                if not isinstance(e, TimeoutError):
+                    self.close()
+                raise
+
+    async def _queryValues(self, cmd, data = None):
+        #Coroutine version of Scintillator._queryValues over the text shell
+        if data is None:
+            data = ""
+        elif isinstance(data, list):
+            data = "".join("{0:04x}".format(v) for v in data)
+        return await self._query(f"pmt {cmd}{data}\r", Scintillator._frameEnd, lambda response: self._textReplyValues(response, cmd),
+                                 exempt=cmd in Scintillator._breakerExempt)
+
+    async def _query(self, command, terminator, parser, count=1, exempt=False):
+        #Coroutine version of Scintillator._query. Only one command per channel is in flight at a time
+        #and the port is shared with other channels and threads through its PortScheduler.
+        async with self._lock, self._portTurn(exempt):
+            loop = asyncio.get_running_loop()
+            self.ser.timeout = 0    # non-blocking, the event loop waits for the port instead
+            self.ser.reset_input_buffer()   # drop late replies and prompts of earlier commands
+            for chunk in self._encodeCommand(command):
+                self.ser.write(chunk)   # commands are a few bytes, they fit the driver's buffer
+                if self.pacing:
+                    await asyncio.sleep(self.pacing)
+
+            size = 0
+            found = 0
+            terminated = terminator is None
+            deadline = loop.time() + self.timeout
+            while(True):
+                if terminator is not None and terminated:
+                    break
+                wait = deadline - loop.time()
+                if terminated and size:
+                    wait = min(wait, self.quiet_time)
+                if wait <= 0 or not await self._waitReadable(loop, wait):
+                    break
+                received = self.ser.read(self.ser.in_waiting or 1)
+                size, matches = self._addToReply(size, received, None if terminated else terminator)
+                found += matches
+                terminated = terminated or found >= count
+                if matches:     # more replies may follow, give each its own timeout
+                    deadline = loop.time() + self.timeout
+            result = parser(self._view[:size])
+            if size:
+                self.circuit_breaker.success()
+            else:
+                self.circuit_breaker.failure()
+            return result
+
+    async def _waitReadable(self, loop, wait):
+        #Waits up to wait seconds for the port to become readable, returns whether it did
+        if self.ser.in_waiting:
+            return True
+        fd = self.ser.fileno()
+        ready = loop.create_future()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(True))
+        try:
+            done, _ = await asyncio.wait({ready}, timeout=wait)
+            return bool(done)
+        finally:
+            loop.remove_reader(fd)
+            ready.cancel()
+
+
+class AsyncScintillators():
+    """
+    AsyncScintillators
+
+    Coroutine version of Scintillators. Commands for all channels run concurrently on the
+    event loop and their results are gathered in channel order.
+
+    Parameters
+    ----------
+    number_of_scints, serial_ports, baud_rate, timeout, quiet_time, pacing, parity
+        Same as Scintillators
+
+    Attributes
+    ----------
+    count : int
+        The total number of scint channels
+    ports : list[str]
+        A list containing the Serial port paths for each scint channel
+    scints : list[AsyncScintillator]
+        A list containing the AsyncScintillator instances corresponding to each channel
+    errors : dict
+        The exceptions raised by the last status or runMethod call, keyed by scint channel
+
+    Methods
+    -------
+    await status()
+        Return a dictionary containing the status of all channels
+    await printStatus()
+        Print a table sumarizing the status of the scintillators
+    await runMethod(method, *args, **kwargs)
+        Run an AsyncScintillator method for all scintillators concurrently. Returns the results in
+        channel order; failed channels give None and their exceptions are collected in errors.
+
+    """
+
+    def __init__(self, number_of_scints = 1, serial_ports = None, baud_rate = 9600, timeout = 1, quiet_time = .05, pacing = None, parity = None):
+
+        self.count = number_of_scints
+
+        if serial_ports is None:
+            serial_ports = [None]*number_of_scints
+        self.ports = serial_ports
+        assert len(serial_ports) == number_of_scints, "Mismatching number of given ports to given number of scintillators"
+
+        self.scints = []
+        for scint_i in range(number_of_scints):
+            self.scints.append(AsyncScintillator(scint_number=scint_i+1, serial_port=self.ports[scint_i], baud_rate=baud_rate,
+                                                timeout=timeout, quiet_time=quiet_time, pacing=pacing, parity=parity))
+        self.errors = {}
+
+    async def status(self):
+        """A dictionary of status parameters"""
+        singleScintStatuses, self.errors = await self._gather("getStatus")
+        return Scintillators._pivotStatus(singleScintStatuses)
+
+    async def printStatus(self):
+        """Print a message outlining the status of all scints"""
+        print(Scintillators._formatStatus(await self.status()))
+
+    async def runMethod(self, method, *args, **kwargs):
+        """Run an AsyncScintillator method for all scintillators"""
+        if method.startswith("_") or not callable(getattr(AsyncScintillator, method, None)):
+            raise AttributeError(f"Class 'AsyncScintillator' does not have method '{method}'")
+        results, self.errors = await self._gather(method, *args, **kwargs)
+        return results
+
+    def help(self):
+        """Display help message"""
+        print(AsyncScintillators.__doc__)
+        print("\nYou can use the following methods from the AsyncScintillator class in runMethod():\n")
+        print(AsyncScintillator.__doc__)
+
+    # -- private methods --
+
+    async def _gather(self, method, *args, **kwargs):
+        """Await a method on every channel at once, returning (results in channel order, errors by channel)"""
+        async def call(scint):
+            result = getattr(scint, method)(*args, **kwargs)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+
+        outcomes = await asyncio.gather(*(call(scint) for scint in self.scints), return_exceptions=True)
+        results = []
+        errors = {}
+        for scint, outcome in zip(self.scints, outcomes):
+            if isinstance(outcome, Exception):
+                results.append(None)
+                errors[scint.scint_channel] = outcome
+            else:
+                results.append(outcome)
+        return results, errors
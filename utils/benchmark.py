@@ -0,0 +1,161 @@
+"""This file defines latency and throughput benchmarks for Scintillator and Scintillators"""
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from utils.scintillator import Scintillator
+from utils.scintillators import Scintillators
+
+# commands timed on a single channel, as (name, method, args, whether it changes the high voltage)
+SINGLE_COMMANDS = [
+    ("getStatus", "getStatus", (), False),
+    ("HV_Set", "HV_Set", (50,), True),
+    ("HV_On", "HV_On", (), True),
+    ("HV_Off", "HV_Off", (), True),
+    ("getMCStatus", "getMCStatus", (), False),
+]
+
+
+class SimulatorProcess():
+    """
+    SimulatorProcess
+
+    Runs a utils.simulator crate in a child process, so that the simulator's CPU time is not
+    counted against the code being measured. Can be used as a context manager.
+
+    Parameters
+    ----------
+    number_of_channels : int
+        The number of simulated channels
+
+    Attributes
+    ----------
+    ports : list[str]
+        The pseudo-terminal paths of the simulated channels
+
+    Methods
+    -------
+    stop()
+        Stop the child process
+
+    """
+
+    def __init__(self, number_of_channels):
+        self._process = subprocess.Popen([sys.executable, "-m", "utils.simulator", str(number_of_channels)],
+                                         stdout=subprocess.PIPE, text=True,
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.ports = [self._process.stdout.readline().split(": ", 1)[1].strip() for _ in range(number_of_channels)]
+
+    def stop(self):
+        self._process.terminate()
+        self._process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def summarize(samples):
+    """Return count, mean, max and the 50th/90th/99th percentiles of a list of seconds"""
+    if len(samples) < 2:
+        value = samples[0] if samples else None
+        return {"n": len(samples), "mean": value, "p50": value, "p90": value, "p99": value, "max": value}
+    percentiles = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "n": len(samples),
+        "mean": statistics.fmean(samples),
+        "p50": percentiles[49],
+        "p90": percentiles[89],
+        "p99": percentiles[98],
+        "max": max(samples),
+    }
+
+
+def timeCall(function, *args, repeats = 20):
+    """Call function repeats times, returning the wall and CPU time summaries in seconds"""
+    wall = []
+    cpu = []
+    for _ in range(repeats):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        function(*args)
+        cpu.append(time.process_time() - cpu_start)
+        wall.append(time.perf_counter() - wall_start)
+    return {"wall": summarize(wall), "cpu": summarize(cpu)}
+
+
+def commandLatency(scint, repeats = 20, change_hv = False):
+    """Per-command latency and CPU time of a Scintillator, of the commands changing the high voltage only if change_hv"""
+    return {name: timeCall(getattr(scint, method), *args, repeats=repeats)
+            for name, method, args, changes_hv in SINGLE_COMMANDS if change_hv or not changes_hv}
+
+
+def sweepThroughput(scints, duration = 2.):
+    """Status sweeps per second of a Scintillators instance, with CPU time per sweep"""
+    sweeps = 0
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        scints.status
+        sweeps += 1
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    return {"channels": scints.count, "sweeps": sweeps, "sweeps_per_s": sweeps / elapsed, "cpu_per_sweep": cpu / sweeps}
+
+
+def runBenchmarks(channel_counts = (1, 2, 4), serial_ports = None, repeats = 20, duration = 2., change_hv = None, **scint_kwargs):
+    """
+    Run all benchmarks and return the results as a JSON serializable dict.
+
+    If serial_ports is None, each channel count is measured against a simulated crate in a child
+    process, otherwise against the given ports (channel counts larger than the number of ports are skipped).
+    The commands changing the high voltage (HV_Set to 50 V, HV_On, HV_Off) are only timed if change_hv,
+    which defaults to True for simulated channels and False for real ones.
+    """
+    if change_hv is None:
+        change_hv = serial_ports is None
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "simulated": serial_ports is None,
+            "repeats": repeats,
+            "change_hv": change_hv,
+            "duration": duration,
+            "settings": scint_kwargs,
+        },
+        "sweeps": [],
+    }
+
+    simulator = SimulatorProcess(1) if serial_ports is None else None
+    try:
+        port = simulator.ports[0] if simulator is not None else serial_ports[0]
+        scint = Scintillator(serial_port=port, **scint_kwargs)
+        results["latency"] = commandLatency(scint, repeats=repeats, change_hv=change_hv)
+        scint.close()
+    finally:
+        if simulator is not None:
+            simulator.stop()
+
+    for count in channel_counts:
+        if serial_ports is not None and count > len(serial_ports):
+            continue
+        simulator = SimulatorProcess(count) if serial_ports is None else None
+        try:
+            ports = simulator.ports if simulator is not None else serial_ports[:count]
+            scints = Scintillators(number_of_scints=count, serial_ports=ports, **scint_kwargs)
+            sweep = sweepThroughput(scints, duration=duration)
+            if change_hv:
+                sweep["runMethod_HV_Set"] = timeCall(scints.runMethod, "HV_Set", 50, repeats=repeats)
+            results["sweeps"].append(sweep)
+            scints.close()
+        finally:
+            if simulator is not None:
+                simulator.stop()
+
+    return results
@@ -0,0 +1,126 @@
+"""This file defines the circuit breaker that stops commands to a scintillator channel that does not reply"""
+import threading
+import time
+
+# breaker states
+CLOSED = "closed"           # the channel replies, commands are sent
+OPEN = "open"               # the channel failed repeatedly, commands fail at once until the next probe
+HALF_OPEN = "half-open"     # one probe command is on its way to find out whether the channel is back
+
+
+class ChannelUnavailable(Exception):
+    def __init__(self, channel, retry_in):
+        super().__init__(channel, retry_in)
+        self.channel = channel
+        self.retry_in = retry_in
+
+    def __str__(self):
+        return f"Scintillator channel {self.channel} unavailable, next probe in {self.retry_in:.1f} s"
+
+
+class CircuitBreaker():
+    """
+    CircuitBreaker
+
+    Tracks whether a channel replies. After failure_threshold consecutive failed commands (no reply
+    or a malformed one) the breaker opens and allow() refuses commands, so sweeps skip the channel
+    instead of waiting for its timeout. Once the backoff delay has passed, allow() lets one probe
+    command through; if it succeeds the breaker closes, otherwise the delay is multiplied by factor
+    (up to max_delay) and the breaker opens again.
+
+    Parameters
+    ----------
+    failure_threshold : int
+        Consecutive failures that open the breaker. Default 3.
+    base_delay : float
+        Seconds until the first probe. Default 1.
+    max_delay : float
+        Upper limit of the delay between probes in seconds. Default 60.
+    factor : float
+        Growth of the delay after each failed probe. Default 2.
+
+    Attributes
+    ----------
+    state : str
+        CLOSED, OPEN or HALF_OPEN
+    failures : int
+        Consecutive failures
+    retry_in : float
+        Seconds until the next probe is allowed, 0 if commands are allowed
+
+    Methods
+    -------
+    allow()
+        Whether a command may be sent now. Starts a probe if the breaker is open and the delay passed.
+    success()
+        Record a command that got a valid reply
+    failure()
+        Record a command that got no or a malformed reply
+    reset()
+        Close the breaker
+
+    """
+
+    def __init__(self, failure_threshold = 3, base_delay = 1., max_delay = 60., factor = 2.):
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self._lock = threading.Lock()
+        self.reset()
+
+    @property
+    def retry_in(self):
+        if self.state == CLOSED:
+            return 0.
+        return max(0., self._nextProbe - time.monotonic())
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if now < self._nextProbe:
+                return False
+            #one probe per delay, a probe that never reports back does not block the next one
+            self.state = HALF_OPEN
+            self._nextProbe = now + self._delay
+            return True
+
+    def success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self._delay = self.base_delay
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self._delay = min(self._delay * self.factor, self.max_delay)
+                self._open()
+            elif self.state == CLOSED and self.failures >= self.failure_threshold:
+                self._open()
+
+    def reset(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self._delay = self.base_delay
+            self._nextProbe = 0.
+
+    def __getstate__(self):
+        #copies sent to another process (see utils.workers) leave the lock behind
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    # -- private methods --
+
+    def _open(self):
+        self.state = OPEN
+        self._nextProbe = time.monotonic() + self._delay
@@ -0,0 +1,27 @@
+"""This file defines the client side of the scintillator control daemon (see utils.daemon)"""
+import json
+import os
+import socket
+
+SOCKET_PATH = os.environ.get("SCINT_SOCKET", "/tmp/scint.sock")
+
+def daemonAvailable(socket_path = SOCKET_PATH):
+    """Whether a daemon socket exists at socket_path"""
+    return os.path.exists(socket_path)
+
+def sendRequest(scint_num, command, args = (), socket_path = SOCKET_PATH, timeout = 30):
+    """
+    Forward a command to the daemon and return its reply dict with keys ok, output, results and errors.
+
+    scint_num is 'all' or a channel number. Raises OSError if the daemon cannot be reached.
+    """
+    request = {"scint": scint_num, "command": command, "args": list(args)}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as reply:
+            line = reply.readline()
+    if not line:
+        raise ConnectionError("The daemon closed the connection without replying")
+    return json.loads(line)
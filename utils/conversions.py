@@ -0,0 +1,172 @@
+"""This file defines the conversions between HV chip ADC codes and physical units, and the per-channel calibration"""
+import json
+import numpy as np
+
+# value of one code of each linearly coded quantity: V, uA, and the temperature coefficients in V/C and V/C^2
+LSB = {
+    "voltage": 1.812e-3,
+    "current": 4.98e-3,
+    "first_coefficient": 5.225e-2,
+    "second_coefficient": 1.507e-3,
+}
+# temperature in C = (code * TEMPERATURE_GAIN - TEMPERATURE_OFFSET) / TEMPERATURE_SLOPE
+TEMPERATURE_GAIN = 1.907e-5
+TEMPERATURE_OFFSET = 1.035
+TEMPERATURE_SLOPE = -5.5e-3
+# largest code of a 4-hex-digit field
+CODE_MAX = 0xffff
+# the kind of conversion of each named quantity of the status and temperature correction settings
+KINDS = {
+    "vo_set": "voltage",
+    "vo_mon": "voltage",
+    "io_mon": "current",
+    "T_mon": "temperature",
+    "dT1_sec": "second_coefficient",
+    "dT2_sec": "second_coefficient",
+    "dT1": "first_coefficient",
+    "dT2": "first_coefficient",
+    "Vb": "voltage",
+    "Tb": "temperature",
+}
+# the converted HPO values, in the order of the HPO reply after the status word
+HPO_QUANTITIES = ["vo_set", "vo_mon", "io_mon", "T_mon"]
+
+def fromCode(codes, kind):
+    """
+    Convert ADC codes (a number or array) to physical units.
+
+    kind is a key of LSB, "temperature", or a quantity name of KINDS. Numbers give a float, arrays
+    an array of the same shape.
+    """
+    kind = KINDS.get(kind, kind)
+    codes = np.asarray(codes)
+    if kind == "temperature":
+        values = (codes * TEMPERATURE_GAIN - TEMPERATURE_OFFSET) / TEMPERATURE_SLOPE
+    else:
+        values = codes * LSB[kind]
+    return _result(values)
+
+def toCode(values, kind, rounding = "truncate"):
+    """
+    Convert physical values (a number or array) to ADC codes, the inverse of fromCode.
+
+    Codes are truncated towards zero as the HV chip setpoints have always been ("truncate"), or
+    rounded to the nearest code ("nearest"), and limited to 0 - CODE_MAX. Numbers give an int, arrays
+    an integer array of the same shape.
+    """
+    kind = KINDS.get(kind, kind)
+    values = np.asarray(values, dtype=np.float64)
+    if kind == "temperature":
+        codes = (TEMPERATURE_OFFSET + TEMPERATURE_SLOPE * values) / TEMPERATURE_GAIN
+    else:
+        codes = values / LSB[kind]
+    if rounding == "truncate":
+        codes = np.trunc(codes)
+    elif rounding == "nearest":
+        codes = np.rint(codes)
+    else:
+        raise ValueError(f"Unknown rounding '{rounding}', use 'truncate' or 'nearest'")
+    return _result(np.clip(codes, 0, CODE_MAX).astype(np.int64))
+
+def fromCodes(codes, quantities = HPO_QUANTITIES):
+    """Convert an array of codes whose last axis holds the given quantities (default the HPO values) to physical units"""
+    codes = np.asarray(codes)
+    values = np.empty(codes.shape, dtype=np.float64)
+    for col, quantity in enumerate(quantities):
+        values[..., col] = fromCode(codes[..., col], quantity)
+    return values
+
+def toCodes(values, quantities = HPO_QUANTITIES, rounding = "truncate"):
+    """Convert an array of physical values whose last axis holds the given quantities to codes, the inverse of fromCodes"""
+    values = np.asarray(values, dtype=np.float64)
+    codes = np.empty(values.shape, dtype=np.int64)
+    for col, quantity in enumerate(quantities):
+        codes[..., col] = toCode(values[..., col], quantity, rounding)
+    return codes
+
+def _result(array):
+    #Plain Python numbers for scalar input, so single readings stay floats and ints
+    return array.item() if array.ndim == 0 else array
+
+
+class Calibration():
+    """
+    Calibration
+
+    Per-channel linear corrections of converted quantities, calibrated = gain * value + offset, with
+    gain 1 and offset 0 for every channel and quantity not in the table. The table is stored as JSON,
+    e.g. {"3": {"vo_mon": [1.002, -0.015], "io_mon": [0.98, 0]}}, and applied to whole arrays at once.
+
+    Parameters
+    ----------
+    table : dict or None
+        {channel: {quantity: (gain, offset)}}. Default no corrections.
+
+    Methods
+    -------
+    load(path)
+        Class method reading a calibration table from a JSON file
+    save(path)
+        Write the table to a JSON file
+    coefficients(channels, quantities)
+        The (gain, offset) arrays of shape (len(channels), len(quantities))
+    apply(values, channels, quantities=HPO_QUANTITIES)
+        Calibrate values whose last two axes are channels and quantities (or only channels if quantities
+        is one quantity name), e.g. a telemetry history of shape (samples, channels, quantities)
+    invert(values, channels, quantities=HPO_QUANTITIES)
+        The uncalibrated values giving calibrated values, e.g. to find the setpoint for a true voltage
+    applySnapshot(snapshot)
+        A StatusSnapshot with calibrated vo_set, vo_mon, io_mon and T_mon columns
+
+    """
+
+    def __init__(self, table = None):
+        self.table = {int(channel): {quantity: tuple(map(float, coefficients)) for quantity, coefficients in quantities.items()}
+                      for channel, quantities in (table or {}).items()}
+        self._cache = {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as table:
+            return cls(json.load(table))
+
+    def save(self, path):
+        with open(path, "w") as table:
+            json.dump({str(channel): {quantity: list(coefficients) for quantity, coefficients in quantities.items()}
+                       for channel, quantities in self.table.items()}, table, indent=1)
+
+    def coefficients(self, channels, quantities):
+        key = (tuple(channels), tuple(quantities))
+        coefficients = self._cache.get(key)
+        if coefficients is None:
+            gain = np.ones((len(channels), len(quantities)))
+            offset = np.zeros((len(channels), len(quantities)))
+            for row, channel in enumerate(channels):
+                for col, quantity in enumerate(quantities):
+                    gain[row, col], offset[row, col] = self.table.get(channel, {}).get(quantity, (1., 0.))
+            coefficients = self._cache[key] = (gain, offset)
+        return coefficients
+
+    def apply(self, values, channels, quantities = HPO_QUANTITIES):
+        gain, offset = self._coefficients(channels, quantities)
+        return gain * np.asarray(values) + offset
+
+    def invert(self, values, channels, quantities = HPO_QUANTITIES):
+        gain, offset = self._coefficients(channels, quantities)
+        return (np.asarray(values) - offset) / gain
+
+    def applySnapshot(self, snapshot):
+        array = snapshot.array.copy()
+        gain, offset = self.coefficients(array["channel"].tolist(), HPO_QUANTITIES)
+        for col, quantity in enumerate(HPO_QUANTITIES):
+            array[quantity] = gain[:, col] * array[quantity] + offset[:, col]
+        return type(snapshot)(array, snapshot.ports, snapshot.timestamp)
+
+    # -- private methods --
+
+    def _coefficients(self, channels, quantities):
+        #The coefficients of one quantity name are columns broadcasting over a trailing channel axis
+        if isinstance(quantities, str):
+            gain, offset = self.coefficients(channels, [quantities])
+            return gain[:, 0], offset[:, 0]
+        return self.coefficients(channels, quantities)
@@ -0,0 +1,128 @@
+"""This file defines the control daemon that keeps the scintillator serial ports open between commands"""
+import json
+import os
+import socket
+import socketserver
+from utils.client import SOCKET_PATH
+from utils.scintillators import Scintillators
+
+class ScintillatorDaemon():
+    """
+    ScintillatorDaemon
+
+    Owns a Scintillators instance with its serial ports open and serves commands from local clients
+    over a Unix socket (see utils.client), so each command costs only the device round trip.
+    Every connection is handled in its own thread; commands for the same channel are serialized by
+    that channel's port lock while commands for different channels run concurrently.
+
+    A request is one JSON line {"scint": "all" or channel number, "command": name, "args": [...]},
+    answered by one JSON line {"ok": bool, "output": str, "results": list, "errors": {channel: message}}.
+    printStatus is answered with the formatted status in output instead of printing on the daemon.
+
+    Parameters
+    ----------
+    socket_path : str
+        Path of the Unix socket to listen on. Default utils.client.SOCKET_PATH.
+    discover : bool
+        Serve all channels of the discovered hubs (see Scintillators.discover). Default False.
+    **kwargs
+        Passed to Scintillators, e.g. number_of_scints and serial_ports
+
+    Attributes
+    ----------
+    scints : Scintillators
+        The controlled scintillator channels
+    socket_path : str
+        Path of the Unix socket
+
+    Methods
+    -------
+    serve()
+        Serve requests until shutdown() is called or the process is interrupted
+    shutdown()
+        Stop serving and remove the socket
+    handle(request)
+        Execute a request dict and return the reply dict
+
+    """
+
+    def __init__(self, socket_path = SOCKET_PATH, discover = False, **kwargs):
+        self.scints = Scintillators.discover(**kwargs) if discover else Scintillators(**kwargs)
+        self.socket_path = socket_path
+        self._removeStaleSocket()
+
+        daemon = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        reply = daemon.handle(json.loads(line))
+                    except ValueError as e:
+                        reply = {"ok": False, "output": f"Invalid request: {e}", "results": [], "errors": {}}
+                    self.wfile.write(json.dumps(reply, default=str).encode("utf-8") + b"\n")
+
+        self._server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        self._server.daemon_threads = True
+        os.chmod(socket_path, 0o660)
+
+    def serve(self):
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def shutdown(self):
+        self._server.shutdown()
+
+    def handle(self, request):
+        scint_num = request.get("scint")
+        cmd = request.get("command")
+        args = request.get("args", [])
+        try:
+            if scint_num == "all":
+                # the errors come with each call, other connections may be running commands at the same time
+                if cmd == "printStatus":
+                    records, errors = self.scints._fanOut("getStatusRecord")
+                    status = Scintillators._pivotStatus([None if record is None else record.asDict() for record in records])
+                    return self._reply(output=Scintillators._formatStatus(status), errors=errors)
+                Scintillators._checkMethod(cmd)
+                results, errors = self.scints._fanOut(cmd, *args)
+                return self._reply(results=results, errors=errors)
+
+            scint_num = int(scint_num)
+            if not 1 <= scint_num <= self.scints.count:
+                raise ValueError("scint_number invalid")
+            scint = self.scints.scints[scint_num-1]
+            if cmd == "printStatus":
+                return self._reply(output=scint._formatStatus(scint.getStatus()))
+            scintMethod = getattr(scint, cmd, None)
+            if not callable(scintMethod) or cmd.startswith("_"):
+                raise AttributeError(f"Class 'Scintillator' does not have command '{cmd}'")
+            try:
+                return self._reply(results=[scintMethod(*args)])
+            except Exception as e:
+                return self._reply(results=[None], errors={scint_num: e})
+        except Exception as e:
+            return {"ok": False, "output": str(e), "results": [], "errors": {}}
+
+    # -- private methods --
+
+    def _reply(self, output = "", results = (), errors = None):
+        return {"ok": True, "output": output, "results": list(results),
+                "errors": {channel: str(e) for channel, e in (errors or {}).items()}}
+
+    def _removeStaleSocket(self):
+        #Removes a socket file left behind by a daemon that is no longer running
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except OSError:
+            os.unlink(self.socket_path)
+        else:
+            raise RuntimeError(f"A daemon is already listening on {self.socket_path}")
+        finally:
+            probe.close()
@@ -0,0 +1,107 @@
+"""This file defines the discovery of USB-COM485 hub interfaces and the cached scintillator channel map"""
+import json
+import os
+import re
+
+BY_ID_DIR = "/dev/serial/by-id"
+CACHE_PATH = os.environ.get("SCINT_CHANNEL_MAP", os.path.expanduser("~/.cache/scint/channels.json"))
+# by-id name of one interface of an FTDI USB-COM485 hub, e.g. usb-FTDI_USB-COM485_Plus4_FT4J7CE9-if00-port0
+HUB_INTERFACE = re.compile(r"^usb-FTDI_USB-COM485_Plus(?P<size>\d+)_(?P<hub>[A-Za-z0-9]+)-if(?P<interface>\d+)-port0$")
+# the single hub the channels were wired to before discovery
+LEGACY_HUB = "FT4J7CE9"
+
+def legacyPort(channel):
+    """The by-id path of a channel on the legacy single hub"""
+    return f"{BY_ID_DIR}/usb-FTDI_USB-COM485_Plus4_{LEGACY_HUB}-if0{int(channel-1)}-port0"
+
+def hubOf(port):
+    """The hub serial number of a by-id port path, or the path itself if it is not a hub interface"""
+    match = HUB_INTERFACE.match(os.path.basename(port))
+    return match.group("hub") if match else port
+
+def discoverChannels(directory = None):
+    """
+    Scan directory for USB-COM485 hub interfaces and return the channel map.
+
+    The map is a list of {"channel", "hub", "interface", "port"} dicts, numbered from 1 in order of
+    hub serial number and interface, so the channels of the legacy hub keep numbers 1-4 when it is
+    the only hub.
+    """
+    directory = BY_ID_DIR if directory is None else directory
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    interfaces = []
+    for name in names:
+        match = HUB_INTERFACE.match(name)
+        if match:
+            interfaces.append((match.group("hub"), int(match.group("interface")), os.path.join(directory, name)))
+    interfaces.sort(key=lambda interface: (interface[0] != LEGACY_HUB, interface[0], interface[1]))
+    return [{"channel": channel, "hub": hub, "interface": interface, "port": port}
+            for channel, (hub, interface, port) in enumerate(interfaces, start=1)]
+
+def channelMap(refresh = False, cache_path = None, directory = None):
+    """
+    The channel map (see discoverChannels), read from cache_path while all its ports still exist.
+
+    Otherwise, or if refresh, the hubs are scanned again and merged into the cached map: a hub
+    interface keeps the channel number it was given once, interfaces not yet mapped are numbered after
+    the highest mapped channel, and the interfaces of a hub that is gone stay mapped, so their channels
+    fail instead of being taken over by another hub. A changed, non-empty map is written to cache_path;
+    delete it to number the channels afresh.
+    """
+    cache_path = CACHE_PATH if cache_path is None else cache_path
+    cached = _readCache(cache_path)
+    if not refresh and cached and all(os.path.exists(channel["port"]) for channel in cached):
+        return cached
+    channels = _mergeChannels(cached, discoverChannels(directory))
+    if channels and channels != cached:
+        _writeCache(channels, cache_path)
+    return channels
+
+def portForChannel(channel, cache_path = None, directory = None):
+    """
+    The port path of a channel from the channel map, or its legacy hub path if there is no map.
+
+    A mapped channel keeps its port even if its hub is gone, ValueError is raised for a channel that
+    is not in a non-empty map.
+    """
+    channels = channelMap(cache_path=cache_path, directory=directory)
+    for entry in channels:
+        if entry["channel"] == channel:
+            return entry["port"]
+    if channels:
+        raise ValueError(f"Channel {channel} is not in the channel map (channels 1-{len(channels)})")
+    return legacyPort(channel)
+
+def _readCache(cache_path):
+    #The cached map, empty if there is none or it cannot be read
+    try:
+        with open(cache_path) as cache:
+            return [{"channel": int(channel["channel"]), "hub": str(channel["hub"]),
+                     "interface": int(channel["interface"]), "port": str(channel["port"])} for channel in json.load(cache)]
+    except (OSError, ValueError, KeyError, TypeError):
+        return []
+
+def _mergeChannels(cached, found):
+    #Keeps the number of every cached interface, taking the port it was found at, and appends the new ones
+    ports = {(channel["hub"], channel["interface"]): channel["port"] for channel in found}
+    channels = [dict(channel, port=ports.pop((channel["hub"], channel["interface"]), channel["port"])) for channel in cached]
+    number = max((channel["channel"] for channel in cached), default=0)
+    for channel in found:
+        if (channel["hub"], channel["interface"]) in ports:
+            number += 1
+            channels.append(dict(channel, channel=number))
+    return sorted(channels, key=lambda channel: channel["channel"])
+
+def _writeCache(channels, cache_path):
+    #Writes the map to a temporary file first so readers never see a partial map
+    try:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        temporary = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as cache:
+            json.dump(channels, cache, indent=1)
+        os.replace(temporary, cache_path)
+    except OSError:
+        pass    # the map is only a cache, discovery works without it
@@ -0,0 +1,105 @@
+"""This file defines the framed STX/cmd/data/ETX/checksum/CR protocol spoken by the HV chip"""
+
+# data bytes in the reply to each command (reply code is the lower case command)
+DATA_SIZES = {
+    "hxx": 4,
+    "hpo": 20,
+    "hst": 24,
+    "hrt": 24,
+    "hof": 0,
+    "hon": 0,
+    "hcm": 0,
+    "hre": 0,
+    "hbv": 0,
+    "hgt": 4,
+    "hgv": 4,
+    "hgc": 4,
+    "hgs": 4,
+    "hsc": 0,
+    "hrc": 4
+}
+ERROR_CODES = {
+    1: "UART Communication Error",
+    2: "Timeout Error",
+    3: "Syntax Error",
+    4: "Checksum Error",
+    5: "Command Error",
+    6: "Parameter Error",
+    7: "Parameter Size Error"
+}
+HEADER_SIZE = 4     # STX and the three character command code
+
+
+class CommandParsingException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class ErrorResponseException(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+        self.message = ERROR_CODES.get(code, "Unknown Error")
+
+    def __str__(self):
+        return "Error ({0}): {1}".format(self.code, self.message)
+
+
+def commandResponseSize(cmd):
+    """Total length of the reply frame for a reply code, e.g. 28 for 'hpo'"""
+    return 8 + DATA_SIZES[cmd]
+
+def encodeFrame(cmd, data = b""):
+    """Build the frame for a command, data may be bytes, a str, an int or a list of ints (4 hex digits each)"""
+    if isinstance(data, str):
+        data = data.encode("ASCII")
+    elif isinstance(data, list):
+        data = b''.join("{0:04x}".format(v).encode("ASCII") for v in data)
+    elif isinstance(data, int):
+        data = "{0:04x}".format(data).encode("ASCII")
+    if not isinstance(data, bytes):
+        raise ValueError("data parameter cannot be converted to bytes, nor is it binary data")
+    cmdLine = b'\x02' + cmd.encode("ASCII") + data + b'\x03'
+    check = "{0:02x}".format(sum(cmdLine) & 0xff).upper().encode("ASCII")
+    return cmdLine + check + b'\x0D'
+
+def replyCode(header):
+    """The lower case reply code from the first HEADER_SIZE bytes of a reply frame"""
+    if len(header) < HEADER_SIZE or header[0] != 0x02:
+        raise CommandParsingException("Frame bytes did not match")
+    try:
+        cmd = bytes(header[1:4]).decode("ASCII").lower()
+    except UnicodeDecodeError:
+        raise CommandParsingException("Reply code is not ASCII")
+    if cmd not in DATA_SIZES:
+        raise CommandParsingException(f"Unknown reply code {cmd!r}")
+    return cmd
+
+def decodeFrame(response):
+    """
+    Check a complete reply frame and return (reply code, list of data values).
+
+    Raises CommandParsingException for malformed frames or checksum mismatches and
+    ErrorResponseException for 'hxx' error replies.
+    """
+    cmd = replyCode(response)
+    if len(response) != commandResponseSize(cmd):
+        raise CommandParsingException("Expected data size does not match received data size")
+    if response[-1] != 0x0D or response[-4] != 0x03:
+        raise CommandParsingException("Frame bytes did not match")
+    try:
+        checkReceived = int(bytes(response[-3:-1]), base=16)
+        data = bytes(response[4:-4])
+        values = [int(data[offset:offset+4], base=16) for offset in range(0, len(data), 4)]
+    except ValueError:
+        raise CommandParsingException("Frame contains non hexadecimal characters")
+    checkCalculated = sum(response[:-3]) & 0xff
+    if checkCalculated != checkReceived:
+        raise CommandParsingException("Checksum mismatch")
+    if cmd == "hxx":
+        raise ErrorResponseException(values[0])
+    return cmd, values
@@ -0,0 +1,87 @@
+"""This file defines the pool of open serial ports shared by the scintillator channels"""
+import os
+import threading
+from serial import Serial, PARITY_NONE
+
+
+class PortPool():
+    """
+    PortPool
+
+    Opens serial ports on first use and shares one open Serial per port path between all channels
+    using it. A pooled port whose device has disappeared or been replaced (e.g. after a USB
+    disconnect and reconnect) is closed and opened again the next time it is requested, and a port
+    that failed during a command can be discarded so the next command reopens it.
+
+    Methods
+    -------
+    open(path, baud_rate=9600, timeout=1, parity=PARITY_NONE)
+        Return the open Serial for path, opening or reopening it if needed
+    discard(path)
+        Close the port so it is reopened on next use
+    close()
+        Close all ports
+    isOpen(path)
+        Whether the pool holds an open port for path
+
+    """
+
+    def __init__(self):
+        self._ports = {}    # path -> Serial
+        self._locks = {}    # path -> lock held while the port is opened or closed
+        self._lock = threading.Lock()
+
+    def open(self, path, baud_rate = 9600, timeout = 1, parity = PARITY_NONE):
+        with self._pathLock(path):
+            ser = self._ports.get(path)
+            if ser is not None and not self._stale(path, ser):
+                if ser.baudrate != baud_rate:
+                    ser.baudrate = baud_rate
+                if ser.parity != parity:
+                    ser.parity = parity
+                return ser
+            self._close(path)
+            ser = Serial(path, baud_rate, timeout=timeout, parity=parity)
+            self._ports[path] = ser
+            return ser
+
+    def discard(self, path):
+        with self._pathLock(path):
+            self._close(path)
+
+    def close(self):
+        for path in list(self._ports):
+            self.discard(path)
+
+    def isOpen(self, path):
+        ser = self._ports.get(path)
+        return ser is not None and ser.is_open
+
+    # -- private methods --
+
+    def _pathLock(self, path):
+        with self._lock:
+            return self._locks.setdefault(path, threading.Lock())
+
+    def _stale(self, path, ser):
+        #Whether the open port no longer refers to the device now at path
+        if not ser.is_open:
+            return True
+        try:
+            opened = os.fstat(ser.fileno())
+            current = os.stat(path)
+        except (OSError, ValueError):
+            return True
+        return (opened.st_dev, opened.st_ino, opened.st_rdev) != (current.st_dev, current.st_ino, current.st_rdev)
+
+    def _close(self, path):
+        ser = self._ports.pop(path, None)
+        if ser is not None:
+            try:
+                ser.close()
+            except OSError:
+                pass
+
+
+# the pool used by all Scintillator instances
+POOL = PortPool()
@@ -0,0 +1,159 @@
+"""This file defines the closed-loop high voltage ramp and power-on of a scintillator channel"""
+import time
+
+MIN_VOLTAGE = 40.   # the HV_Set range accepted by the microcontroller
+MAX_VOLTAGE = 60.
+ON_DIVERGENCE = ("rollback", "off", "hold")
+
+
+class RampError(Exception):
+    def __init__(self, channel, setpoint, readback, action, verified):
+        super().__init__(channel, setpoint, readback, action, verified)
+        self.channel = channel
+        self.setpoint = setpoint
+        self.readback = readback
+        self.action = action
+        self.verified = verified
+
+    def __str__(self):
+        readback = "no readback" if self.readback is None else f"vo_mon {self.readback:.3f} V"
+        verified = "nothing verified" if self.verified is None else f"last verified {self.verified:g} V"
+        return f"Channel {self.channel} did not follow the ramp to {self.setpoint:g} V ({readback}), {self.action} ({verified})"
+
+
+class SettleError(Exception):
+    def __init__(self, channel, setpoint, readback, action):
+        super().__init__(channel, setpoint, readback, action)
+        self.channel = channel
+        self.setpoint = setpoint
+        self.readback = readback
+        self.action = action
+
+    def __str__(self):
+        return f"Channel {self.channel} did not settle at {self.setpoint:g} V (vo_mon {self.readback:.3f} V), {self.action}"
+
+
+class _Diverged(Exception):
+    def __init__(self, readback):
+        super().__init__(readback)
+        self.readback = readback
+
+
+def rampSetpoints(start, target, step):
+    """The setpoints from start (exclusive) to target (inclusive) in steps of at most step volts"""
+    if step <= 0:
+        raise ValueError("step must be positive")
+    setpoints = []
+    voltage = start
+    while abs(target - voltage) > 1e-9:
+        voltage = min(voltage + step, target) if target > voltage else max(voltage - step, target)
+        setpoints.append(voltage)
+    return setpoints
+
+def rampChannel(scint, target, step = 1., rate = 1., tolerance = .5, verify_timeout = 2., poll_interval = .05,
+                on_divergence = "rollback", turn_on = True):
+    """
+    Ramp one channel to target volts and return the verified voltage.
+
+    The setpoint moves in steps of at most step volts, at most rate volts per second. After each
+    step the output voltage (vo_mon) is read back until it is within tolerance of the setpoint; if it
+    is not within verify_timeout seconds, or a command fails, the channel is handled per on_divergence
+    ('rollback' to the last verified voltage, 'off' to turn the HV off, or 'hold' to leave it) and
+    RampError is raised. A channel whose HV is off is set to the lowest voltage and turned on first
+    if turn_on, otherwise RampError is raised.
+    """
+    if not MIN_VOLTAGE <= target <= MAX_VOLTAGE:
+        raise ValueError(f"Voltage is not within the appropriate range! It should be between {MIN_VOLTAGE:g}V and {MAX_VOLTAGE:g}V.")
+    if on_divergence not in ON_DIVERGENCE:
+        raise ValueError(f"Unknown on_divergence '{on_divergence}', use one of {list(ON_DIVERGENCE)}")
+
+    verified = None
+    setpoint = None
+    try:
+        if scint.getChipStatus()["high_voltage_on"]:
+            #start from the known setpoint, or the present output if it was set elsewhere
+            start = scint.HV if scint.HV is not None else scint.getOutputVoltage()
+            verified = start = min(max(start, MIN_VOLTAGE), MAX_VOLTAGE)
+        elif turn_on:
+            setpoint = start = min(MIN_VOLTAGE, target)
+            scint.HV_Set(setpoint)
+            scint.HV_On()
+            verified = _verify(scint, setpoint, tolerance, verify_timeout, poll_interval)
+        else:
+            raise RampError(scint.scint_channel, target, None, "HV is off", None)
+
+        step_time = step / rate
+        for setpoint in rampSetpoints(start, target, step):
+            step_start = time.monotonic()
+            scint.HV_Set(setpoint)
+            verified = _verify(scint, setpoint, tolerance, verify_timeout, poll_interval)
+            remaining = step_time - (time.monotonic() - step_start)
+            if remaining > 0:
+                time.sleep(remaining)
+        return verified
+
+    except RampError:
+        raise
+    except Exception as e:
+        readback = e.readback if isinstance(e, _Diverged) else None
+        action = _recover(scint, verified, on_divergence)
+        raise RampError(scint.scint_channel, target if setpoint is None else setpoint, readback, action, verified) from e
+
+def powerOnChannel(scint, settle_time = .5, tolerance = .5, stable_timeout = 10., poll_interval = .05):
+    """
+    Turn one channel's HV on and return its output voltage once it is stable.
+
+    The channel is stable once the output voltage (vo_mon) has stayed within tolerance of the set
+    voltage (Scintillator.HV, or vo_set from the status if not known) for settle_time seconds. If it
+    is not stable within stable_timeout seconds, the HV is turned off again and SettleError is raised;
+    it is also turned off again if a readback fails. ValueError is raised if the set voltage is not known.
+    """
+    setpoint = scint.HV if scint.HV is not None else scint.getStatus()["vo_set"]
+    if setpoint is None or setpoint == -1:
+        raise ValueError(f"The set voltage of channel {scint.scint_channel} is not known, set it with HV_Set first")
+    try:
+        scint.HV_On()
+        deadline = time.monotonic() + stable_timeout
+        stable_since = None
+        while(True):
+            readback = scint.getOutputVoltage()
+            now = time.monotonic()
+            if abs(readback - setpoint) > tolerance:
+                stable_since = None
+            elif stable_since is None:
+                stable_since = now
+            if stable_since is not None and now - stable_since >= settle_time:
+                return readback
+            if now >= deadline:
+                break
+            time.sleep(poll_interval)
+    except BaseException:
+        #a channel that is not known to be stable does not stay on
+        _recover(scint, None, "off")
+        raise
+    raise SettleError(scint.scint_channel, setpoint, readback, _recover(scint, None, "off"))
+
+
+def _verify(scint, setpoint, tolerance, verify_timeout, poll_interval):
+    #Reads vo_mon until it is within tolerance of setpoint, returns the setpoint or raises _Diverged
+    deadline = time.monotonic() + verify_timeout
+    while(True):
+        readback = scint.getOutputVoltage()
+        if abs(readback - setpoint) <= tolerance:
+            return setpoint
+        if time.monotonic() >= deadline:
+            raise _Diverged(readback)
+        time.sleep(poll_interval)
+
+def _recover(scint, verified, on_divergence):
+    #Puts a diverged channel into a safe state, returns what was done
+    try:
+        if on_divergence == "off" or (on_divergence == "rollback" and verified is None):
+            scint.HV_Off()
+            return "turned HV off"
+        if on_divergence == "rollback":
+            scint.HV_Set(verified)
+            return f"rolled back to {verified:g} V"
+        return "held"
+    except Exception as e:
+        return f"recovery failed: {e}"
@@ -0,0 +1,320 @@
+"""This file defines the priority command scheduler that hands out turns on a serial port"""
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+import threading
+import time
+import weakref
+
+# priority classes, most urgent first
+PRIORITIES = ["safety", "operator", "monitoring"]
+DEFAULT_PRIORITY = "operator"
+# seconds a command of each class may wait for the port before it is dropped, None waits forever
+DEFAULT_DEADLINES = {
+    "safety": None,
+    "operator": None,
+    "monitoring": 2.,
+}
+
+_context = threading.local()
+_schedulers = weakref.WeakValueDictionary()
+_schedulersLock = threading.Lock()
+
+
+class QueueFull(Exception):
+    def __init__(self, level, size):
+        super().__init__(level, size)
+        self.level = level
+        self.size = size
+
+    def __str__(self):
+        return f"{self.size} {self.level} commands already waiting for the port"
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, level, waited):
+        super().__init__(level, waited)
+        self.level = level
+        self.waited = waited
+
+    def __str__(self):
+        return f"Dropped {self.level} command after waiting {self.waited:.3f} s for the port"
+
+
+@contextmanager
+def priority(level, deadline = None):
+    """Commands sent by the current thread inside the context use this priority class (and deadline in seconds)"""
+    if level not in PRIORITIES:
+        raise ValueError(f"Unknown priority '{level}', use one of {PRIORITIES}")
+    previous = getattr(_context, "current", None)
+    entering_safety = level == "safety" and (previous is None or previous[0] != "safety")
+    if entering_safety:
+        # the schedulers this safety context takes turns on, they alone yield when it is left
+        outer_used = getattr(_context, "safety_used", None)
+        _context.safety_used = []
+    _context.current = (level, deadline)
+    try:
+        yield
+    finally:
+        _context.current = previous
+        if entering_safety:
+            used, _context.safety_used = _context.safety_used, outer_used
+            for scheduler in used:
+                scheduler._yieldSafety()
+
+def currentPriority():
+    """The (priority class, deadline) of the current thread, (DEFAULT_PRIORITY, None) outside priority()"""
+    return getattr(_context, "current", None) or (DEFAULT_PRIORITY, None)
+
+def schedulerFor(port):
+    """The PortScheduler shared by all channels on a serial port path"""
+    with _schedulersLock:
+        scheduler = _schedulers.get(port)
+        if scheduler is None:
+            scheduler = _schedulers[port] = PortScheduler()
+        return scheduler
+
+
+def _usedInSafety(scheduler):
+    #Records that the current thread's safety context took a turn on scheduler
+    used = getattr(_context, "safety_used", None)
+    if used is not None and not any(other is scheduler for other in used):
+        used.append(scheduler)
+
+
+class _Ticket():
+    __slots__ = ("level", "channel", "enqueued", "expires", "notify")
+
+    def __init__(self, level, channel, notify = None):
+        self.level = level
+        self.channel = channel
+        self.enqueued = time.monotonic()
+        self.expires = None     # monotonic time the ticket is dropped at, None waits forever
+        self.notify = notify    # called when the turn is handed to the ticket, besides notifying the condition
+
+
+class PortScheduler():
+    """
+    PortScheduler
+
+    Hands out turns on one serial port, one command (or pipelined batch) at a time. Waiting commands
+    are served by priority class (see PRIORITIES, taken from the calling thread's priority() context),
+    and within a class round robin across the channels sharing the port. Each time a thread leaves a
+    safety context in which it used the port, the next turn goes to a lower class so a fast safety
+    poller cannot starve the port.
+    Queues are bounded per class and commands that wait longer than their deadline are dropped.
+
+    Parameters
+    ----------
+    max_queue : int
+        The number of commands of one class that may wait, further ones raise QueueFull. Default 16.
+    deadlines : dict or None
+        Seconds each class may wait before DeadlineExceeded is raised. Default DEFAULT_DEADLINES.
+
+    Attributes
+    ----------
+    depth : dict
+        The number of commands currently waiting, per class
+
+    Methods
+    -------
+    turn(channel=None)
+        Context manager holding the port for one command of a channel
+    asyncTurn(channel=None)
+        Async context manager holding the port for one command of a channel, waiting on the event loop
+    metrics()
+        Per class queue depth, maximum depth, counts of served, dropped and rejected commands, mean and
+        maximum wait time in seconds, and the utilization of the port since the last reset
+    resetMetrics()
+        Restart the metrics
+
+    """
+
+    def __init__(self, max_queue = 16, deadlines = None):
+        self.max_queue = max_queue
+        self.deadlines = dict(DEFAULT_DEADLINES if deadlines is None else deadlines)
+        self._condition = threading.Condition()
+        self._queues = {level: OrderedDict() for level in PRIORITIES}   # channel -> deque of tickets
+        self._granted = None
+        self._held = False
+        self._yielding = False
+        self.resetMetrics()
+
+    @property
+    def depth(self):
+        with self._condition:
+            return {level: self._depth(level) for level in PRIORITIES}
+
+    @contextmanager
+    def turn(self, channel = None):
+        self._acquire(channel)
+        try:
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def asyncTurn(self, channel = None):
+        loop = asyncio.get_running_loop()
+        granted = asyncio.Event()
+        ticket = self._enqueue(channel, lambda: loop.call_soon_threadsafe(granted.set))
+        try:
+            while(True):
+                with self._condition:
+                    if self._granted is ticket:
+                        self._take(ticket)
+                        break
+                    wait = self._remaining(ticket)
+                    if wait is not None and wait <= 0:
+                        raise self._dropped(ticket)
+                    granted.clear()
+                try:
+                    await asyncio.wait_for(granted.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass    # the deadline is checked again holding the lock
+        except BaseException:
+            with self._condition:
+                self._abandon(ticket)
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def metrics(self):
+        with self._condition:
+            elapsed = time.monotonic() - self._metricsStart
+            busy = self._busy + (time.monotonic() - self._heldSince if self._held else 0.)
+            metrics = {}
+            for level in PRIORITIES:
+                stats = self._stats[level]
+                metrics[level] = {
+                    "depth": self._depth(level),
+                    "max_depth": stats["max_depth"],
+                    "served": stats["served"],
+                    "dropped": stats["dropped"],
+                    "rejected": stats["rejected"],
+                    "mean_wait": stats["wait"] / stats["served"] if stats["served"] else 0.,
+                    "max_wait": stats["max_wait"],
+                }
+            metrics["utilization"] = busy / elapsed if elapsed > 0 else 0.
+            return metrics
+
+    def resetMetrics(self):
+        with self._condition:
+            self._stats = {level: {"max_depth": 0, "served": 0, "dropped": 0, "rejected": 0, "wait": 0., "max_wait": 0.}
+                           for level in PRIORITIES}
+            self._metricsStart = time.monotonic()
+            self._busy = 0.
+            self._heldSince = self._metricsStart
+
+    # -- private methods --
+
+    def _depth(self, level):
+        return sum(len(tickets) for tickets in self._queues[level].values())
+
+    def _acquire(self, channel):
+        ticket = self._enqueue(channel)
+        with self._condition:
+            try:
+                while self._granted is not ticket:
+                    wait = self._remaining(ticket)
+                    if wait is not None and wait <= 0:
+                        raise self._dropped(ticket)
+                    self._condition.wait(wait)
+            except BaseException:
+                self._abandon(ticket)
+                raise
+            self._take(ticket)
+
+    def _enqueue(self, channel, notify = None):
+        #Queues a ticket of the current thread's priority class, handing it the port at once if it is free
+        level, deadline = currentPriority()
+        ticket = _Ticket(level, channel, notify)
+        with self._condition:
+            depth = self._depth(level)
+            if depth >= self.max_queue:
+                self._stats[level]["rejected"] += 1
+                raise QueueFull(level, depth)
+            self._queues[level].setdefault(channel, deque()).append(ticket)
+            self._stats[level]["max_depth"] = max(self._stats[level]["max_depth"], depth + 1)
+            if deadline is None:
+                deadline = self.deadlines.get(level)
+            ticket.expires = None if deadline is None else ticket.enqueued + deadline
+            if not self._held and self._granted is None:
+                self._grantNext()
+        return ticket
+
+    def _remaining(self, ticket):
+        #Seconds the ticket may still wait, None without a deadline
+        return None if ticket.expires is None else ticket.expires - time.monotonic()
+
+    def _dropped(self, ticket):
+        #Counts a ticket that waited past its deadline and returns the exception to raise
+        self._stats[ticket.level]["dropped"] += 1
+        return DeadlineExceeded(ticket.level, time.monotonic() - ticket.enqueued)
+
+    def _abandon(self, ticket):
+        #Gives up the place in the queue, or passes on a turn handed over meanwhile
+        if self._granted is ticket:
+            self._grantNext()
+        else:
+            self._remove(ticket)
+
+    def _take(self, ticket):
+        #The granted ticket takes the port
+        self._granted = None
+        self._held = True
+        self._heldSince = time.monotonic()
+        waited = self._heldSince - ticket.enqueued
+        stats = self._stats[ticket.level]
+        stats["served"] += 1
+        stats["wait"] += waited
+        stats["max_wait"] = max(stats["max_wait"], waited)
+        if ticket.level == "safety":
+            _usedInSafety(self)
+
+    def _release(self):
+        with self._condition:
+            self._held = False
+            self._busy += time.monotonic() - self._heldSince
+            self._grantNext()
+
+    def _yieldSafety(self):
+        #Called when a thread leaves a safety context: lower classes get the next turn
+        with self._condition:
+            self._yielding = True
+            if not self._held and self._granted is not None and self._granted.level == "safety":
+                #take back a turn handed to safety but not yet taken
+                ticket, self._granted = self._granted, None
+                self._queues["safety"].setdefault(ticket.channel, deque()).appendleft(ticket)
+                self._queues["safety"].move_to_end(ticket.channel, last=False)
+                self._grantNext()
+
+    def _grantNext(self):
+        #Hands the port to the next waiting ticket: highest class first, round robin across channels
+        levels = PRIORITIES
+        if self._yielding and any(self._queues[level] for level in PRIORITIES[1:]):
+            levels = PRIORITIES[1:]
+        self._yielding = False
+        for level in levels:
+            queue = self._queues[level]
+            if queue:
+                channel, tickets = next(iter(queue.items()))
+                self._granted = tickets.popleft()
+                if tickets:
+                    queue.move_to_end(channel)
+                else:
+                    del queue[channel]
+                self._condition.notify_all()
+                if self._granted.notify is not None:
+                    self._granted.notify()
+                return
+        self._granted = None
+
+    def _remove(self, ticket):
+        tickets = self._queues[ticket.level].get(ticket.channel)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self._queues[ticket.level][ticket.channel]
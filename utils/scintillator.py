@@ -1,6 +1,17 @@
 """This file defines the Scintillator class holding immediate commands to the scintillator"""
-from serial import Serial
+from concurrent.futures import Future
+from contextlib import contextmanager, nullcontext
+from serial import PARITY_EVEN, PARITY_NONE, SerialException
 import time
+import re
+import threading
+from utils import breaker
+from utils import conversions
+from utils import discovery
+from utils import frames
+from utils import portpool
+from utils import scheduler
+from utils.status import StatusRecord, hvFlags
 
 class Scintillator():
     """
@@ -13,10 +24,38 @@ class Scintillator():
     scint_number : int
         The label describing the scintillator channel.
     serial_port : str
-        The serial port path for connecting via Serial. If None (default), then the device path is
-        assumed to be in /dev/serial/by-id/ with ID "usb-FTDI_USB-COM485_Plus4_FT4J7CE9-if0{scint_number - 1}-port0".
+        The serial port path for connecting via Serial. If None (default), the port of scint_number in
+        the channel map discovered from the USB-COM485 hubs in /dev/serial/by-id/ (see utils.discovery),
+        or "usb-FTDI_USB-COM485_Plus4_FT4J7CE9-if0{scint_number - 1}-port0" there if it is not mapped.
     baud_rate : int
         The baud rate for connection via Serial. Default 9600.
+    timeout : float
+        Hard limit in seconds on waiting for a reply to a command. Default 1.
+    quiet_time : float
+        A reply without a recognizable end (the microcontroller status) is considered complete after
+        the line has been quiet for this many seconds. Default 0.05.
+    pacing : float or None
+        If given, commands are written one character at a time with this delay in seconds between
+        characters, for firmware that cannot keep up with a burst. If None (default), each command
+        is written in a single write.
+    status_max_age : float
+        If positive, getStatus returns a status read less than this many seconds ago instead of
+        querying the channel again. Default 0 (always query).
+    transport : str
+        "text" (default) sends commands through the microcontroller's "pmt ..." text shell.
+        "frame" talks the HV chip's framed STX/cmd/data/ETX/checksum/CR protocol directly: each reply
+        is a fixed-length read whose checksum is verified, and error replies raise exceptions.
+    parity : str or None
+        Serial parity. If None (default), even parity for the frame transport and no parity otherwise.
+    port_scheduler : PortScheduler or None
+        Hands out the turns on the serial port. If None (default), the utils.scheduler.PortScheduler
+        shared by all channels on the same port path.
+    circuit_breaker : CircuitBreaker or None
+        Stops commands to the channel after repeated missing or malformed replies. If None (default),
+        a utils.breaker.CircuitBreaker with its default threshold and backoff.
+    hub_slot : semaphore or None
+        Shared by the channels of one USB-COM485 hub to limit how many of them run a command at the
+        same time: each command holds one of its slots while it has the port. If None (default), no limit.
 
     Attributes
     ----------
@@ -25,20 +64,58 @@ class Scintillator():
     port
         The serial port path
     ser
-        The Serial instance
+        The Serial instance, opened on first use and shared by all channels on the same port path
+        (see utils.portpool)
     HV
-        The currently set high voltage value
+        The high voltage value last set through HV_Set, None if not set since the channel was opened
+    timeout
+        The hard limit in seconds on waiting for a reply
+    quiet_time
+        The quiet period in seconds that closes a reply without a terminator
+    pacing
+        The delay in seconds between written characters, or None to write commands in one burst
+    status_max_age
+        The maximum age in seconds of a cached status returned by getStatus
+    transport
+        "text" or "frame", the protocol used by the command methods
+    port_scheduler
+        The PortScheduler serializing the commands on the port
+    circuit_breaker
+        The CircuitBreaker of the channel. While it is open, commands other than safety commands and
+        HV_Off raise ChannelUnavailable at once and getStatus returns an "unavailable" status without querying.
+    hub_slot
+        The semaphore limiting the commands running at once on the channel's hub, or None
     help
         The class docstring
     
     Methods
     -------
-    sendCommand(command)
-        Send a command over serial interface
+    sendCommand(command, terminator=None)
+        Send a command over serial interface and read the reply until it is complete
+    sendFrame(cmd, data=b"")
+        Send a HV chip command frame and return the reply code and data values of the checked reply
+    priority(level, deadline=None)
+        Context manager: commands sent by the current thread inside it wait for the port in the priority
+        class level ('safety', 'operator' (default) or 'monitoring'), dropped with DeadlineExceeded after
+        waiting deadline seconds (default per class, 2 s for monitoring)
+    urgent()
+        Same as priority('safety'), e.g. for an overcurrent trip
+    queueMetrics()
+        Return the port's per class queue depth, wait times and dropped commands and its utilization
+    batch(commands, pipelined=None)
+        Run several commands, e.g. [("HV_Off",), ("HV_Set", 50), ("HV_On",), ("getStatus",)], writing
+        them back to back and matching the replies in order. Returns a list of results or exceptions
     getHVStatus(status)
         Get HV status returned from HPO command (whose result must be used as input)
-    getStatus()
-        Return a dictionary of status values
+    getStatus(max_age=None)
+        Return a dictionary of status values, from the cache if younger than max_age (default status_max_age).
+        Its "state" is "ok", "not detected" (no reply) or "unavailable" (circuit breaker open).
+    getStatusRecord(max_age=None)
+        Return the status as a compact StatusRecord (see utils.status), which getStatus turns into its dict
+    close()
+        Close the serial port, the next command opens it again
+    invalidateStatus()
+        Drop the cached status so the next getStatus queries the channel
     printStatus()
         Print the status elements
     HV_On()
@@ -48,135 +125,262 @@ class Scintillator():
     HV_Set(voltage)
         Set high voltage to given voltage value. Must be between 40 and 60 V
     getMCStatus
-        Return status of the microcontroller
+        Return status of the microcontroller (text transport only)
+    getOutputVoltage()
+        Return the monitored output voltage in V (HGV, 4 data bytes)
+    getOutputCurrent()
+        Return the monitored output current in uA (HGC, 4 data bytes)
+    getTemperature()
+        Return the monitored temperature in degrees C (HGT, 4 data bytes)
+    getChipStatus()
+        Return the HV status flags as in getHVStatus (HGS, 4 data bytes)
+    getTemperatureCorrectionFactor()
+        Return the temperature correction settings (HRT)
+    setTemperatureCorrectionFactor(dT1_s, dT2_s, dT1, dT2, tb)
+        Set the temperature correction settings (HST)
     
     """
 
     # private attributes to all instances
-    _voltageConversionFactor = 1.812e-3
-    _currentConversionFactor = 4.98e-3
-    _firstCoefficientConversionFactor = 5.225e-2
-    _secondCoefficientConversionFactor = 1.507e-3
+    _frameEnd = re.compile(rb"\x03[0-9A-Fa-f]{2}\r")   # ETX, checksum, CR closing a HV chip frame
+    _terminatorWindow = 16   # bytes of reply tail searched for the terminator
+    _replyBufferSize = 256   # initial size of the per-port reply buffer, grown if a reply is longer
+    _replyFrame = re.compile(rb"\x02[a-z]{3}[0-9A-Fa-f]*\x03[0-9A-Fa-f]{2}\r")   # a complete HV chip reply frame
+    _frameStart = re.compile(rb"\x02")    # STX opening a HV chip frame
+    _breakerExempt = ("HOF",)   # HV chip commands sent even while the circuit breaker is open
+    # HV chip command and reply conversion of the methods batch() can pipeline (HV_Set is built by _batchCommand)
+    _batchCommands = {
+        "HV_On": ("HON", lambda self, values: "High Voltage On!"),
+        "HV_Off": ("HOF", lambda self, values: "High Voltage Off!"),
+        "HV_Set": ("HBV", None),
+        "getStatus": ("HPO", lambda self, values: self._statusFromData(values)),
+        "getStatusRecord": ("HPO", lambda self, values: self._recordFromData(values)),
+        "getOutputVoltage": ("HGV", lambda self, values: conversions.fromCode(values[0], "voltage")),
+        "getOutputCurrent": ("HGC", lambda self, values: conversions.fromCode(values[0], "current")),
+        "getTemperature": ("HGT", lambda self, values: conversions.fromCode(values[0], "temperature")),
+        "getChipStatus": ("HGS", lambda self, values: self.getHVStatus(values[0])),
+        "getTemperatureCorrectionFactor": ("HRT", lambda self, values: self._temperatureCorrectionFromData(values)),
+    }
     
-    def __init__(self, scint_number = 1, serial_port = None, baud_rate = 9600):
+    def __init__(self, scint_number = 1, serial_port = None, baud_rate = 9600, timeout = 1, quiet_time = .05, pacing = None, status_max_age = 0,
+                 transport = "text", parity = None, port_scheduler = None, circuit_breaker = None,
+                 hub_slot = None):
 
         self.scint_channel = scint_number
+        self.HV = None      # unknown until set through HV_Set
 
-        if serial_port is None:     # if not given, assume by-id method
-            serial_id = f"usb-FTDI_USB-COM485_Plus4_FT4J7CE9-if0{int(scint_number-1)}-port0"
-            serial_port = f"/dev/serial/by-id/{serial_id}"
+        if serial_port is None:     # if not given, look the channel up in the discovered channel map
+            serial_port = discovery.portForChannel(scint_number)
         self.port = serial_port
-        self.ser = Serial(serial_port, baud_rate)
+        if transport not in ("text", "frame"):
+            raise ValueError(f"Unknown transport '{transport}', use 'text' or 'frame'")
+        self.transport = transport
+        if parity is None:
+            parity = PARITY_EVEN if transport == "frame" else PARITY_NONE
+        self.baud_rate = baud_rate
+        self.parity = parity
+        self._ser = None    # opened through the port pool on first use
+        self.timeout = timeout
+        self.quiet_time = quiet_time
+        self.pacing = pacing
+        self.port_scheduler = scheduler.schedulerFor(self.port) if port_scheduler is None else port_scheduler
+        self.circuit_breaker = breaker.CircuitBreaker() if circuit_breaker is None else circuit_breaker
+        self.hub_slot = hub_slot
+        self._buffer = bytearray(Scintillator._replyBufferSize)
+        self._view = memoryview(self._buffer)
+        self.status_max_age = status_max_age
+        self._statusLock = threading.Lock()
+        self._statusCache = None     # (time read, status dict)
+        self._statusInflight = {}    # priority class -> Future of its HPO query currently in flight
+        self._statusGeneration = 0   # bumped by invalidateStatus
 
 
     @property
     def help(self):
         return Scintillator.__doc__
+
+    @property
+    def ser(self):
+        if self._ser is None or not self._ser.is_open:
+            self._ser = portpool.POOL.open(self.port, self.baud_rate, self.timeout, self.parity)
+        return self._ser
+
+    def close(self):
+        """Close the serial port, it is opened again by the next command"""
+        portpool.POOL.discard(self.port)
+        self._ser = None
+    
+    def priority(self, level, deadline=None):
+        """Commands sent by this thread inside the returned context wait for the port in priority class level"""
+        return scheduler.priority(level, deadline)
+
+    def urgent(self):
+        """Commands sent by this thread inside the returned context go before all others waiting for the port"""
+        return scheduler.priority("safety")
+
+    def queueMetrics(self):
+        """Queue depth, wait time and utilization metrics of this channel's serial port"""
+        return self.port_scheduler.metrics()
+
+    def sendCommand(self, command, terminator=None):
+        #sends a command over the serial interface and returns the response as bytes.
+        #The reply ends as soon as terminator (a compiled bytes regex, e.g. the ETX/checksum/CR
+        #closing a HV chip frame) has been received; trailing prompt bytes are dropped with the input
+        #buffer before the next command. Without a terminator the quiet gap after the first received
+        #bytes ends the reply. timeout is only a fallback.
+        return self._query(command, terminator, bytes)
+
+    def sendFrame(self, cmd, data=b""):
+        #Sends a HV chip command frame and returns (reply code, data values) of the reply frame.
+        #The reply is read with two fixed-length reads: the header, whose code gives the frame
+        #length, then the rest. Raises TimeoutError if nothing arrives within timeout,
+        #frames.CommandParsingException for corrupted frames and frames.ErrorResponseException
+        #for error replies.
+        with self._portTurn(cmd in Scintillator._breakerExempt):
+            self.ser.reset_input_buffer()   # drop leftovers of an earlier, timed out reply
+            for chunk in self._encodeCommand(frames.encodeFrame(cmd, data)):
+                self.ser.write(chunk)
+                if self.pacing:
+                    time.sleep(self.pacing)
+
+            code, values = frames.decodeFrame(self._readFrame(cmd))
+            if code != cmd.lower():
+                raise frames.CommandParsingException(f"Reply {code} does not match command {cmd}")
+            self.circuit_breaker.success()
+        return code, values
     
-    def sendCommand(self, command):
-        #sends a command over the serial interface and returns the response as a byte list.
-        for char in command:
-            self.ser.write(char.encode('ascii'))
-            time.sleep(.01)
-
-        response = []
-        start_time=time.time()
-        while(True):
-            if self.ser.in_waiting>0:
-                received_byte = self.ser.read()
-                response.append(received_byte)
-            if time.time()-start_time>=1:
-                break
-        return(response)
+    def batch(self, commands, pipelined=None):
+        """Run several commands on this channel, returning a list with a result or exception per command
+
+        Each command is a method name or a tuple (method name, *args) of one of the HV chip commands
+        HV_On, HV_Off, HV_Set, getStatus, getStatusRecord, getOutputVoltage, getOutputCurrent, getTemperature,
+        getChipStatus and getTemperatureCorrectionFactor. If pipelined (default: with the frame
+        transport), all commands are written back to back and the replies are matched to them in order
+        by their reply codes, saving the turnaround between commands. Over the text shell this requires
+        firmware that buffers input while a command runs. Otherwise the commands run one after another.
+        """
+        if pipelined is None:
+            pipelined = self.transport == "frame"
+        commands = [(command,) if isinstance(command, str) else tuple(command) for command in commands]
+        if not pipelined:
+            results = []
+            for name, *args in commands:
+                try:
+                    results.append(getattr(self, self._batchMethod(name))(*args))
+                except Exception as e:
+                    results.append(e)
+            return results
+
+        results, pending = self._prepareBatch(commands)
+        if not pending:
+            return results
+        if self.transport == "frame":
+            replies = self._pipelineFrames(pending)
+        else:
+            replies = self._query(self._batchLine(pending), Scintillator._frameEnd, self._splitFrames, count=len(pending),
+                                  exempt=self._batchExempt(pending))
+        return self._finishBatch(results, pending, replies)
     
     def getHVStatus(self, status):
         #Interprets the bytes returned by HPO to help give the HV status
+        return hvFlags(status)
 
-        high_voltage = (status & 1) != 0
-        overcurrent_protection = (status & 2) != 0
-        current_in_specification = (status & 4) == 0
-        sensor_connected = (status & 8) == 0
-        sensor_in_specification = (status & 16) == 0
-        temp_conv_ef = (status & 64) == 0
-        return {
-            "high_voltage_on": high_voltage,
-            "overcurrent_protection": overcurrent_protection,
-            "current_in_specification": current_in_specification,
-            "sensor_connected": sensor_connected,
-            "sensor_in_specification": sensor_in_specification,
-            "temperature_conversion_effective": temp_conv_ef
-        }
-
-    def getStatus(self):
-        """Get the status dict of HV chip--voltages, temperatures, configuration settings"""
-        classStatus = {
-            "channel": self.scint_channel,
-            "serial port": self.port,
-        }
-        response = self.sendCommand("pmt HPO\r")
-        byte_string = b''.join(response[byte] for byte in range(99, len(response)-8))
-        byte_list = self._separate_byte_string(byte_string)
-        data = [int(byte.decode("ascii"), 16) for byte in byte_list] #turning that list into ints
-        if len(data)==5:
-            HVstatus = self.getHVStatus(data[0])
-            vo_set = data[1] * Scintillator._voltageConversionFactor
-            vo_mon = data[2] * Scintillator._voltageConversionFactor
-            io_mon = data[3] * Scintillator._currentConversionFactor
-            T_mon = self._temperatureConversionFunction(data[4])
-        else:
-            print(f"Warning: Scintillator channel {self.scint_channel} not detected")
-            classStatus['HV set'] = None
-            HVstatus = self.getHVStatus(0)
-            for key in HVstatus:
-                HVstatus[key] = -1
-            vo_set = -1
-            vo_mon = -1
-            io_mon = -1
-            T_mon = -1
-        status_dict = {
-            **classStatus,
-            **HVstatus,
-            "vo_set": vo_set,
-            "vo_mon": vo_mon,
-            "io_mon": io_mon,
-            "T_mon": T_mon
-        }
-        return status_dict
+    def getStatus(self, max_age=None):
+        """Get the status dict of HV chip--voltages, temperatures, configuration settings
+
+        A status read less than max_age (default status_max_age) seconds ago is returned from the cache.
+        Concurrent callers of the same priority class share a single HPO query: only one is in flight per
+        channel and class and the others wait for its result, so each waits with its own class's deadline.
+        """
+        return self.getStatusRecord(max_age).asDict()
+
+    def getStatusRecord(self, max_age=None):
+        """Get the status as a StatusRecord (see utils.status), cached and shared like getStatus; do not modify it"""
+        max_age = self.status_max_age if max_age is None else max_age
+        level = scheduler.currentPriority()[0]
+        with self._statusLock:
+            if max_age and self._statusCache is not None and time.monotonic() - self._statusCache[0] < max_age:
+                return self._statusCache[1]
+            inflight = self._statusInflight.get(level)
+            if inflight is None:
+                inflight = self._statusInflight[level] = Future()
+                generation = self._statusGeneration
+            else:
+                generation = None   # another caller is querying
+        if generation is None:
+            return inflight.result()
+
+        try:
+            read_time = time.monotonic()
+            record = self._readStatus()
+        except Exception as e:
+            with self._statusLock:
+                del self._statusInflight[level]
+            inflight.set_exception(e)
+            raise
+        with self._statusLock:
+            del self._statusInflight[level]
+            if generation == self._statusGeneration:    # not invalidated meanwhile
+                self._statusCache = (read_time, record)
+        inflight.set_result(record)
+        return record
+
+    def invalidateStatus(self):
+        """Drop the cached status, e.g. after a command that changes the channel state"""
+        with self._statusLock:
+            self._statusCache = None
+            self._statusGeneration += 1
     
     def printStatus(self):
         """Give a nice print message outlining the status"""
-        status_dict = self.getStatus()
-        status_msg = ""
-        for key in status_dict:
-            status_msg += f"{key} -- {status_dict[key]}\n"
-        print(status_msg)
+        print(self._formatStatus(self.getStatus()))
     
     def HV_On(self):
-        #Turns HV on
-        command = "pmt HON\r"
-        self.sendCommand(command)
+        #Turns HV on, raises unless the HV chip acknowledged it
+        self._queryValues("HON")
+        self.invalidateStatus()
         return "High Voltage On!"
     
     def HV_Off(self):
-        #Turns off HV
-        command = "pmt HOF\r"
-        self.sendCommand(command)
+        #Turns off HV, raises unless the HV chip acknowledged it
+        self._queryValues("HOF")
+        self.invalidateStatus()
         return "High Voltage Off!"
 
     def HV_Set(self, voltage):
         #Sets the High Voltage to any value between 40 and 60--the range that the MC accepts
-        if voltage < 40 or voltage >60:
-            raise ValueError("Voltage is not within the appropriate range! It should be between 40V and 60V.")
-        converted_voltage = voltage / Scintillator._voltageConversionFactor
-        hex_string = hex(int(converted_voltage))[2:]  # Convert the integer to hex and remove the '0x' prefix
-        command = "pmt HBV"+ hex_string+"\r"
-        self.sendCommand(command)
+        #the setpoint is only recorded once the HV chip has acknowledged it
+        self._queryValues("HBV", [self._hvSetCode(voltage)])
+        self.HV = voltage
+        self.invalidateStatus()
         return "HV set to "+ str(voltage) +"V"
 
     def getMCStatus(self):
+        if self.transport == "frame":
+            raise RuntimeError("The microcontroller status is only available with the text transport")
         command = "status\r"
-        response = self.sendCommand(command)
-        return "Microcontroller Status: " + self._bytes_to_string(response[8:17])+ ", " + self._bytes_to_string(response[19:27])
+        return self._query(command, None, self._parseMCStatus)
+
+    def getOutputVoltage(self):
+        return conversions.fromCode(self._queryValues("HGV")[0], "voltage")
+
+    def getOutputCurrent(self):
+        return conversions.fromCode(self._queryValues("HGC")[0], "current")
+
+    def getTemperature(self):
+        return conversions.fromCode(self._queryValues("HGT")[0], "temperature")
+
+    def getChipStatus(self):
+        return self.getHVStatus(self._queryValues("HGS")[0])
+
+    def getTemperatureCorrectionFactor(self):
+        return self._temperatureCorrectionFromData(self._queryValues("HRT"))
+
+    def setTemperatureCorrectionFactor(self, dT1_s, dT2_s, dT1, dT2, tb):
+        vb = self.getTemperatureCorrectionFactor().get("Vb")
+        self._queryValues("HST", self._temperatureCorrectionCodes(dT1_s, dT2_s, dT1, dT2, tb, vb))
+        self.invalidateStatus()
+        return "Temperature correction factors set"
 
 #    def lgsel(self, toggle):
 #        #Turns on or off the low gain select option based on user input
@@ -196,17 +400,337 @@ class Scintillator():
 
     # -- private methods --
 
-    def _temperatureConversionFunction(self, x):
-        return (x * 1.907e-5 - 1.035) / (-5.5e-3)
+    def _formatStatus(self, status_dict):
+        status_msg = ""
+        for key in status_dict:
+            status_msg += f"{key} -- {status_dict[key]}\n"
+        return status_msg
+
+    @contextmanager
+    def _portTurn(self, exempt=False):
+        #Holds the port for one command (see port_scheduler), (re)opening it through the port pool.
+        #Raises breaker.ChannelUnavailable while the circuit breaker is open, except for safety commands
+        #and exempt ones (turning the HV off must not be refused).
+        #Missing or malformed replies and port errors count as breaker failures; the caller records
+        #a success. A port failing with an OS error other than a timeout, e.g. after a USB
+        #disconnect, is closed so the next command opens it again.
+        #The hub slot is taken after the port turn, so a command never holds a slot while it queues
+        #for its port, and released with it, so ramps and power-ons only hold it per command.
+        if not exempt and scheduler.currentPriority()[0] != "safety" and not self.circuit_breaker.allow():
+            raise breaker.ChannelUnavailable(self.scint_channel, self.circuit_breaker.retry_in)
+        with self.port_scheduler.turn(self.scint_channel), (nullcontext() if self.hub_slot is None else self.hub_slot):
+            try:
+                self._ser = portpool.POOL.open(self.port, self.baud_rate, self.timeout, self.parity)
+                yield
+            except frames.CommandParsingException:
+                self.circuit_breaker.failure()
+                raise
+            except OSError as e:
+                self.circuit_breaker.failure()
+                if not isinstance(e, TimeoutError):
+                    self.close()
+                raise
+
+    def _query(self, command, terminator, parser, count=1, exempt=False):
+        #Sends a command, reads the reply into this port's reusable buffer and returns
+        #parser(memoryview of the reply). The view is only valid inside parser since the buffer
+        #is reused by the next command, so parsers must copy anything they keep.
+        #The reply ends at the count-th terminator (for pipelined commands), or after the quiet gap
+        #without a terminator.
+        with self._portTurn(exempt):    # one command at a time per port, concurrent callers wait their turn
+            self.ser.reset_input_buffer()   # drop late replies and prompts of earlier commands
+            for chunk in self._encodeCommand(command):
+                self.ser.write(chunk)
+                if self.pacing:
+                    time.sleep(self.pacing)
+
+            size = 0
+            found = 0
+            terminated = terminator is None
+            deadline = time.monotonic() + self.timeout
+            while(True):
+                if terminator is not None and terminated:
+                    break
+                # block in the driver until bytes arrive instead of polling in_waiting
+                wait = deadline - time.monotonic()
+                if terminated and size:
+                    wait = min(wait, self.quiet_time)
+                if wait <= 0:
+                    break
+                self.ser.timeout = wait
+                received = self.ser.read(max(1, self.ser.in_waiting))
+                if not received:    # quiet gap after the terminator, or hard timeout
+                    break
+                size, matches = self._addToReply(size, received, None if terminated else terminator)
+                found += matches
+                terminated = terminated or found >= count
+                if matches:     # more replies may follow, give each its own timeout
+                    deadline = time.monotonic() + self.timeout
+            result = parser(self._view[:size])
+            if size:
+                self.circuit_breaker.success()
+            else:
+                self.circuit_breaker.failure()
+            return result
+
+    def _queryValues(self, cmd, data = None):
+        #Sends a HV chip command over the selected transport and returns its reply data values.
+        #Over the text shell the reply frame is found and checked by _textReplyValues.
+        #Commands in _breakerExempt are sent even while the circuit breaker is open.
+        if self.transport == "frame":
+            return self.sendFrame(cmd, b"" if data is None else data)[1]
+        if data is None:
+            data = ""
+        elif isinstance(data, list):
+            data = "".join("{0:04x}".format(v) for v in data)
+        return self._query(f"pmt {cmd}{data}\r", Scintillator._frameEnd, lambda response: self._textReplyValues(response, cmd),
+                           exempt=cmd in Scintillator._breakerExempt)
+
+    def _readFrame(self, cmd):
+        #Reads one reply frame with two fixed-length reads: the header, whose code gives the frame
+        #length, then the rest. Must be called holding the port lock.
+        self.ser.timeout = self.timeout
+        header = self.ser.read(frames.HEADER_SIZE)
+        if not header:
+            raise TimeoutError(f"No reply to {cmd} from scintillator channel {self.scint_channel}")
+        if len(header) < frames.HEADER_SIZE:
+            raise frames.CommandParsingException("Unexpected end of data")
+        rest_size = frames.commandResponseSize(frames.replyCode(header)) - frames.HEADER_SIZE
+        rest = self.ser.read(rest_size)
+        if len(rest) < rest_size:
+            raise frames.CommandParsingException("Unexpected end of data")
+        return header + rest
+
+    def _batchCommand(self, name, *args):
+        #Returns (HV chip command, data value or None, function converting the reply values to the method's result)
+        if name == "HV_Set":
+            voltage, = args
+            return "HBV", self._hvSetCode(voltage), lambda values: self._hvSetDone(voltage)
+        if name not in Scintillator._batchCommands or args:
+            raise ValueError(f"'{name}{args if args else ''}' cannot be batched")
+        cmd, convert = Scintillator._batchCommands[name]
+        return cmd, None, lambda values: convert(self, values)
+
+    def _batchMethod(self, name):
+        #The method running a batched command, AttributeError for one that cannot be batched
+        if name not in Scintillator._batchCommands:
+            raise AttributeError(f"'{name}' cannot be batched")
+        return name
+
+    def _prepareBatch(self, commands):
+        #Builds the frames of a pipelined batch, commands that cannot be built fail without being sent.
+        #Returns (results holding their exceptions, pending (index, cmd, data, convert) of the others)
+        results = [None]*len(commands)
+        pending = []
+        for index, (name, *args) in enumerate(commands):
+            try:
+                pending.append((index,) + self._batchCommand(name, *args))
+            except Exception as e:
+                results[index] = e
+        return results, pending
+
+    def _batchExempt(self, pending):
+        #A batch turning the HV off is sent even while the circuit breaker is open
+        return any(cmd in Scintillator._breakerExempt for _, cmd, _, _ in pending)
+
+    def _batchLine(self, pending):
+        #The text shell line writing the pending commands back to back
+        return "".join(f"pmt {cmd}{'' if data is None else '{0:04x}'.format(data)}\r" for _, cmd, data, _ in pending)
+
+    def _finishBatch(self, results, pending, replies):
+        #Matches the replies of a pipelined batch to the pending commands and fills in their results
+        for (index, cmd, data, convert), reply in zip(pending, self._matchReplies([cmd for _, cmd, _, _ in pending], replies)):
+            if isinstance(reply, Exception):
+                results[index] = reply
+                continue
+            try:
+                results[index] = convert(reply)
+            except Exception as e:
+                results[index] = e
+        if any(cmd in ("HON", "HOF", "HBV", "HST") for _, cmd, _, _ in pending):
+            self.invalidateStatus()
+        return results
+
+    def _hvSetDone(self, voltage):
+        #Records an acknowledged HV_Set sent in a batch
+        self.HV = voltage
+        return "HV set to "+ str(voltage) +"V"
+
+    def _pipelineFrames(self, pending):
+        #Writes the frames of all pending commands at once, then reads one reply per command.
+        #Returns a list of (code, values) or exceptions, one per reply read.
+        replies = []
+        with self._portTurn(self._batchExempt(pending)):
+            self.ser.reset_input_buffer()
+            line = b"".join(frames.encodeFrame(cmd, b"" if data is None else data) for _, cmd, data, _ in pending)
+            for chunk in self._encodeCommand(line):
+                self.ser.write(chunk)
+                if self.pacing:
+                    time.sleep(self.pacing)
+            for _, cmd, _, _ in pending:
+                try:
+                    replies.append(self._decodeReply(self._readFrame(cmd)))
+                except frames.CommandParsingException as e:
+                    # the byte stream can no longer be split into frames
+                    replies.append(e)
+                    self.ser.reset_input_buffer()
+                    break
+                except TimeoutError as e:
+                    replies.append(e)
+                    break
+            if any(not isinstance(reply, Exception) for reply in replies):
+                self.circuit_breaker.success()
+            else:
+                self.circuit_breaker.failure()
+        return replies
+
+    def _splitFrames(self, response):
+        #Finds the HV chip reply frames in a text shell reply, returns a list of (code, values) or exceptions
+        return [self._decodeReply(bytes(match.group(0))) for match in Scintillator._replyFrame.finditer(response)]
+
+    def _decodeReply(self, reply):
+        try:
+            return frames.decodeFrame(reply)
+        except frames.ErrorResponseException as e:
+            return ("hxx", e)
+        except frames.CommandParsingException as e:
+            return e
+
+    def _matchReplies(self, expected, replies):
+        #Assigns replies to the expected commands in order by their reply codes. An error reply (hxx)
+        #answers the command it stands in place of, a reply matching a later command means the
+        #commands in between got no reply.
+        matched = []
+        replies = list(replies)
+        for position, cmd in enumerate(expected):
+            code = cmd.lower()
+            while replies:
+                reply = replies[0]
+                if isinstance(reply, Exception):
+                    matched.append(replies.pop(0))
+                    break
+                if reply[0] == "hxx":
+                    matched.append(replies.pop(0)[1])
+                    break
+                if reply[0] == code:
+                    matched.append(replies.pop(0)[1])
+                    break
+                if reply[0] in (c.lower() for c in expected[position+1:]):
+                    matched.append(frames.CommandParsingException(f"No reply to {cmd}"))
+                    break
+                replies.pop(0)  # a reply to none of the commands, skip it
+            else:
+                matched.append(TimeoutError(f"No reply to {cmd} from scintillator channel {self.scint_channel}"))
+        return matched
+
+    def _readStatus(self):
+        #Queries HPO over the selected transport and returns the StatusRecord
+        try:
+            if self.transport == "frame":
+                code, data = self.sendFrame("HPO")
+                return self._recordFromData(data)
+            return self._query("pmt HPO\r", Scintillator._frameEnd, self._parseStatus)
+        except (TimeoutError, SerialException):
+            # no reply, or no device to open the port of
+            return self._recordFromData(None)
+        except breaker.ChannelUnavailable:
+            return self._recordFromData(None, "unavailable")
+
+    def _parseStatus(self, response):
+        #Builds the StatusRecord from the HPO frame in the reply to "pmt HPO"
+        return self._recordFromData(self._textReplyValues(response, "HPO"))
+
+    def _textReplyValues(self, response, cmd):
+        #Finds the HV chip frame in a text shell reply, wherever the echo, banner and prompt put it,
+        #and returns its data values. Raises TimeoutError if the HV chip did not reply,
+        #frames.CommandParsingException for a corrupted frame or one answering another command
+        #and frames.ErrorResponseException for an error reply.
+        match = Scintillator._replyFrame.search(response)
+        if match is None:
+            if Scintillator._frameStart.search(response) is None:
+                raise TimeoutError(f"No {cmd} reply from scintillator channel {self.scint_channel}")
+            raise frames.CommandParsingException(f"{cmd} reply frame is incomplete or corrupted")
+        code, values = frames.decodeFrame(bytes(match.group(0)))
+        if code != cmd.lower():
+            raise frames.CommandParsingException(f"Reply {code} does not match command {cmd}")
+        return values
+
+    def _statusFromData(self, data, state = "not detected"):
+        #Builds the status dict from the five HPO values, see _recordFromData
+        return self._recordFromData(data, state).asDict()
+
+    def _recordFromData(self, data, state = "not detected"):
+        #Builds the StatusRecord from the five HPO values, or a record in the given state if data is not that.
+        #A channel that was not detected gives -1 values in its dict, an unavailable one None.
+        if data is not None and len(data)==5:
+            return StatusRecord(self.scint_channel, self.port, "ok", data[0],
+                                *conversions.fromCodes(data[1:]).tolist())
+        if state == "not detected":
+            print(f"Warning: Scintillator channel {self.scint_channel} not detected")
+        return StatusRecord(self.scint_channel, self.port, state)
+
+    def _hvSetCode(self, voltage):
+        #Converts a voltage between 40 and 60 to the HBV value
+        if voltage < 40 or voltage >60:
+            raise ValueError("Voltage is not within the appropriate range! It should be between 40V and 60V.")
+        return conversions.toCode(voltage, "voltage")
+
+    def _parseMCStatus(self, response):
+        #The status lines follow the echoed command, a late prompt of the previous reply may come first
+        start = max(0, bytes(response).find(b"status\r\n"))
+        return "Microcontroller Status: " + self._bytes_to_string(response[start+8:start+17])+ ", " + self._bytes_to_string(response[start+19:start+27])
+
+    def _encodeCommand(self, command):
+        #Returns the chunks to write for a command: the whole command, or single characters when pacing
+        encoded = command if isinstance(command, bytes) else command.encode('ascii')
+        if self.pacing:
+            return [encoded[i:i+1] for i in range(len(encoded))]
+        return [encoded]
+
+    def _addToReply(self, size, received, terminator):
+        #Copies received bytes behind the first size bytes of the reply buffer and returns
+        #(new size, number of terminators completed by these bytes). Pass terminator=None once
+        #no more terminators are needed.
+        end = size + len(received)
+        if end > len(self._buffer):
+            self._view.release()
+            self._buffer = self._buffer + bytearray(max(end, 2*len(self._buffer)) - len(self._buffer))
+            self._view = memoryview(self._buffer)
+        self._view[size:end] = received
+        if terminator is None:
+            return end, 0
+        start = max(0, size-self._terminatorWindow+1)
+        return end, sum(1 for match in terminator.finditer(self._view[start:end]) if start+match.end() > size)
+
+    def _temperatureCorrectionCodes(self, dT1_s, dT2_s, dT1, dT2, tb, vb):
+        #Checks the temperature correction settings and returns the six HST data values, keeping the reference voltage vb
+        dTs_max, dTs_min = conversions.fromCode([0xfc18, 0x03e8], "second_coefficient").tolist()
+        dT_max = conversions.fromCode(0xfff, "first_coefficient")
+        tb_min, tb_max = conversions.fromCode([0x0000, 0xffff], "temperature").tolist()
+
+        if not 0 <= dT1 <= dT_max:
+            raise ValueError("dT1 must be in range 0V - {0}V".format(dT_max))
+        if not 0 <= dT2 <= dT_max:
+            raise ValueError("dT2 must be in range 0V - {0}V".format(dT_max))
+        if not dTs_min <= dT1_s <= dTs_max:
+            raise ValueError("dT1_s must be in range {0}V - {1}V".format(dTs_min, dTs_max))
+        if not dTs_min <= dT2_s <= dTs_max:
+            raise ValueError("dT2_s must be in range {0}V - {1}V".format(dTs_min, dTs_max))
+        if not min(tb_min, tb_max) <= tb <= max(tb_min, tb_max):
+            raise ValueError("Tb must be in range {0}C - {1}C".format(min(tb_min, tb_max), max(tb_min, tb_max)))
+
+        codes = conversions.toCodes([dT1_s, dT2_s, dT1, dT2, tb], ["dT1_sec", "dT2_sec", "dT1", "dT2", "Tb"])
+        return codes[:4].tolist() + [conversions.toCode(vb, "voltage"), codes[4].item()]
+
+    def _temperatureCorrectionFromData(self, data):
+        quantities = ["dT1_sec", "dT2_sec", "dT1", "dT2", "Vb", "Tb"]
+        return dict(zip(quantities, conversions.fromCodes(data, quantities).tolist()))
+
     
     def _bytes_to_string(self, byte_list):
         try:
-            string = b''.join(byte_list).decode("ascii")
+            string = bytes(byte_list).decode("ascii")
             return string
         except Exception as e:
             print(f"Error converting bytes to string: {e}")
             return None
-    
-    def _separate_byte_string(self, input_bytes):
-        separated_bytes = [input_bytes[i:i+4] for i in range(0, len(input_bytes), 4)]
-        return separated_bytes
\ No newline at end of file
@@ -1,6 +1,15 @@
 """Class for handling multiple scintillator instances at once"""
 
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from utils import discovery
+from utils import ramping
+from utils import scheduler
+from utils import workers
 from utils.scintillator import Scintillator
+from utils.status import StatusSnapshot, pivot
+from utils.watchdog import Watchdog
 
 
 class Scintillators():
@@ -8,6 +17,11 @@ class Scintillators():
     Scintillators
 
     Handles scintillator commands simultaneously for all scintillator channels given.
+    Each channel is on its own serial port, so commands for all channels are sent in parallel
+    from a thread pool sized to the channel count and their results are gathered in channel order.
+    Ports are opened on first use, so a missing device only fails the commands of its own channel.
+    The pool threads send with the priority class of the calling thread (see Scintillator.priority).
+    Ramps and power-ons run on threads of their own, so status reads are not held up while they last.
     An individual scintillator channel can also be used via the scints attribute.
 
     Parameters
@@ -18,6 +32,31 @@ class Scintillators():
         If given, each element is assigned as the port in Serial for each scint channel
     baud_rate : int
         The baud rate for Serial connection.
+    timeout : float
+        Hard limit in seconds on waiting for a reply, passed to each Scintillator.
+    quiet_time : float
+        Quiet period in seconds that closes a reply without a terminator, passed to each Scintillator.
+    pacing : float or None
+        Delay in seconds between written characters, passed to each Scintillator. If None, commands
+        are written in a single write.
+    status_max_age : float
+        Maximum age in seconds of a cached channel status returned by status, passed to each
+        Scintillator. Default 0 (always query).
+    transport : str
+        "text" or "frame", the protocol each Scintillator uses (see Scintillator).
+    parity : str or None
+        Serial parity passed to each Scintillator.
+    max_per_hub : int or None
+        The number of channels of one USB-COM485 hub that run a serial command at the same time, each
+        command taking one of the hub's slots (see Scintillator hub_slot), so a ramp or power-on only
+        holds a slot while it talks to its channel. If None (default), all channels run at once.
+        With isolation "channel", where the channels of a hub run in different processes, it must be None.
+    isolation : str or None
+        If "channel" or "hub", each channel or each hub runs in its own worker process (see
+        utils.workers) and scints holds ChannelProxy instances forwarding to them, so a hung port
+        cannot block the other channels. If None (default), all channels run in this process.
+    worker_deadline : float
+        Seconds a worker may take for one command before it is restarted. Default 30.
 
     Attributes
     ----------
@@ -25,54 +64,283 @@ class Scintillators():
         The total number of scint channels
     ports : list[str]
         A list containing the Serial port paths for each scint channel
+    hubs : list[str]
+        The hub serial number of each scint channel (its port path if it is not on a hub)
     scints : list[Scintillator]
         A list containing the Scintillator instances corresponding to each channel. Can
         be used to access functions for a single scintillator channel.
+    workers : WorkerPool or None
+        The worker processes if isolation is used
     status : dict
-        A dictionary containing the status of all channels
+        A dictionary containing the status of all channels. Channel statuses younger than
+        status_max_age are served from each channel's cache. Channels whose circuit breaker is open
+        are not queried and have the state "unavailable".
+    snapshot : StatusSnapshot
+        The status of all channels as one NumPy structured array row per channel (see utils.status),
+        read like status. Channels that raised have the state "error".
+    health : list[str]
+        The circuit breaker state of each channel ("closed", "open" or "half-open")
+    errors : dict
+        The exceptions raised by the last status or runMethod call, keyed by scint channel
+    watchdogs : list[Watchdog]
+        The running watchdogs, one per channel, if startWatchdogs was called
     
     Methods
     -------
+    discover(refresh=False, **kwargs)
+        Class method: Scintillators for all channels of all USB-COM485 hubs found in /dev/serial/by-id
+        (see utils.discovery), or the four legacy channels if none is found
     printStatus()
         Print a table sumarizing the status of the scintillators
+    getQuantity(quantity)
+        Read a single quantity ('vo_mon', 'io_mon', 'T_mon' or 'status') from all channels in parallel
+        with the minimal-payload HGV/HGC/HGT/HGS queries. Returns the values in channel order; failed
+        channels give None and their exceptions are collected in errors.
     runMethod(method, *args, **kwargs)
-        Run a Scintillator method for all scintillators. *args and **kwargs should be for the requested method.
+        Run a Scintillator method for all scintillators in parallel. *args and **kwargs should be for the
+        requested method. Returns the results in channel order; failed channels give None and their
+        exceptions are collected in errors.
+    rampHV(targets, step=1, rate=1, tolerance=0.5, verify_timeout=2, on_divergence='rollback', turn_on=True)
+        Ramp all channels in parallel to targets (one voltage, or a list with one voltage or None per
+        channel) in steps of step volts at rate volts per second, verifying every step against vo_mon.
+        A channel that does not follow is rolled back to its last verified voltage ('rollback'),
+        turned off ('off') or left ('hold'). Returns (verified voltages in channel order, errors by
+        channel); failed channels give None and their RampError.
+    powerOn(voltages=None, max_concurrent=1, settle_time=0.5, tolerance=0.5, stable_timeout=10)
+        Turn the HV of all channels on with at most max_concurrent channels in transition at a time,
+        in channel order. Voltages (one, or a list with one per channel) are set on all channels first.
+        A channel's slot is freed once its vo_mon readback has stayed within tolerance of the set voltage
+        for settle_time seconds; one that is not stable within stable_timeout is turned off again.
+        Returns (settled output voltages in channel order, errors by channel); failed channels give
+        None and their exception.
+    close()
+        Close the serial ports of all channels, they are opened again by the next command
+    startWatchdogs(max_current, max_voltage=None, rate=20, **kwargs)
+        Start a Watchdog on every channel that turns its HV off as soon as a limit is crossed.
+        Returns the list of Watchdogs in channel order.
+    stopWatchdogs()
+        Stop the watchdogs started by startWatchdogs
     
     """
 
-    def __init__(self, number_of_scints = 1, serial_ports = None, baud_rate = 9600):
+    # Scintillator methods reading a single quantity
+    _quantityMethods = {
+        "vo_mon": "getOutputVoltage",
+        "io_mon": "getOutputCurrent",
+        "T_mon": "getTemperature",
+        "status": "getChipStatus",
+    }
+
+    def __init__(self, number_of_scints = 1, serial_ports = None, baud_rate = 9600, timeout = 1, quiet_time = .05, pacing = None, status_max_age = 0,
+                 transport = "text", parity = None, max_per_hub = None, isolation = None, worker_deadline = 30.):
 
         self.count = number_of_scints
 
         if serial_ports is None:
             serial_ports = [None]*number_of_scints
-        self.ports = serial_ports
         assert len(serial_ports) == number_of_scints, "Mismatching number of given ports to given number of scintillators"
+        self.ports = [discovery.portForChannel(scint_i+1) if port is None else port for scint_i, port in enumerate(serial_ports)]
+        self.hubs = [discovery.hubOf(port) for port in self.ports]
+
+        scint_kwargs = dict(baud_rate=baud_rate, timeout=timeout, quiet_time=quiet_time, pacing=pacing,
+                            status_max_age=status_max_age, transport=transport, parity=parity)
+        if isolation is None:
+            self.workers = None
+            # serial commands on one hub wait for one of its slots
+            hubSlots = {hub: threading.BoundedSemaphore(max_per_hub) for hub in self.hubs} if max_per_hub else {}
+            self.scints = [Scintillator(scint_number=scint_i+1, serial_port=port, hub_slot=hubSlots.get(hub), **scint_kwargs)
+                           for scint_i, (port, hub) in enumerate(zip(self.ports, self.hubs))]
+        elif isolation in ("channel", "hub"):
+            if max_per_hub and isolation == "channel":
+                raise ValueError("max_per_hub needs the channels of a hub in one process, use isolation None or 'hub'")
+            # one worker per channel, or per hub with all its channels sharing the hub's slots
+            groups = {}
+            for scint_i, (port, hub) in enumerate(zip(self.ports, self.hubs)):
+                key = scint_i if isolation == "channel" else hub
+                groups.setdefault(key, {})[scint_i+1] = dict(serial_port=port, **scint_kwargs)
+            self.workers = workers.WorkerPool(list(groups.values()), deadline=worker_deadline, slots=max_per_hub)
+            self.scints = [self.workers.proxy(scint_i+1) for scint_i in range(number_of_scints)]
+        else:
+            raise ValueError(f"Unknown isolation '{isolation}', use None, 'channel' or 'hub'")
 
-        self.scints = []
-        for scint_i in range(number_of_scints):
-            self.scints.append(Scintillator(scint_number=scint_i+1, serial_port=self.ports[scint_i], baud_rate=baud_rate))
+        self.errors = {}
+        self.watchdogs = []
+        self._executor = ThreadPoolExecutor(max_workers=max(1, number_of_scints), thread_name_prefix="scint")
 
     
+    @classmethod
+    def discover(cls, refresh = False, **kwargs):
+        """Scintillators for every discovered hub channel, kwargs are passed to Scintillators"""
+        channels = discovery.channelMap(refresh=refresh)
+        if not channels:
+            return cls(number_of_scints=4, **kwargs)
+        return cls(number_of_scints=len(channels), serial_ports=[channel["port"] for channel in channels], **kwargs)
+
     @property
     def status(self):
         """A dictionary of status parameters"""
 
-        allStatusesDict = {}
-        singleScintStatuses = []
+        records, self.errors = self._fanOut("getStatusRecord")
+        return Scintillators._pivotStatus([None if record is None else record.asDict() for record in records])
+
+    @property
+    def snapshot(self):
+        """The status of all channels as a StatusSnapshot"""
+        snapshot, self.errors = self._takeSnapshot()
+        return snapshot
+
+    @property
+    def health(self):
+        """The circuit breaker state of each channel"""
+        return [scint.circuit_breaker.state for scint in self.scints]
 
-        for scint in self.scints:
-            singleScintStatuses.append(scint.getStatus())
-        
-        for key in singleScintStatuses[0]:
-            allStatusesDict[key] = [singleScintStatuses[i][key] for i in range(self.count)]
-        
-        return allStatusesDict
-        
     def printStatus(self):
         """Print a message outlining the status of all scints"""
-        status_dict = self.status
+        print(Scintillators._formatStatus(self.status))
+    
+    def getQuantity(self, quantity):
+        """Read one quantity from all scintillators"""
+        if quantity not in Scintillators._quantityMethods:
+            raise ValueError(f"Unknown quantity '{quantity}', use one of {list(Scintillators._quantityMethods)}")
+        results, self.errors = self._fanOut(Scintillators._quantityMethods[quantity])
+        return results
+    
+    def runMethod(self, method, *args, **kwargs):
+        """Run a Scintillator method for all scintillators"""
+        Scintillators._checkMethod(method)
+        results, self.errors = self._fanOut(method, *args, **kwargs)
+        return results
+
+    def rampHV(self, targets, **kwargs):
+        """Ramp all channels to their target voltages at once, checking each step against the readback, returning (results, errors)"""
+        if not isinstance(targets, (list, tuple)):
+            targets = [targets]*self.count
+        if len(targets) != self.count:
+            raise ValueError(f"Expected {self.count} targets, got {len(targets)}")
+        level, deadline = scheduler.currentPriority()
+        with self._longRunning() as executor:
+            futures = [None if target is None else
+                       self._submitTo(executor, scint, level, deadline, ramping.rampChannel, scint, target, **kwargs)
+                       for scint, target in zip(self.scints, targets)]
+            return self._collect(futures)
+
+    def powerOn(self, voltages = None, max_concurrent = 1, **kwargs):
+        """Turn all channels on, at most max_concurrent at a time, each waiting for a stable readback, returning (results, errors)"""
+        level, deadline = scheduler.currentPriority()
+        failed = {}
+        if voltages is not None:
+            if not isinstance(voltages, (list, tuple)):
+                voltages = [voltages]*self.count
+            if len(voltages) != self.count:
+                raise ValueError(f"Expected {self.count} voltages, got {len(voltages)}")
+            futures = [self._submit(scint, level, deadline, scint.HV_Set, voltage)
+                       for scint, voltage in zip(self.scints, voltages)]
+            _, failed = self._collect(futures)
+
+        # a channel's slot is taken here in channel order and freed when its power-on finishes,
+        # so settling channels overlap with the commands of the next ones
+        slots = threading.BoundedSemaphore(max_concurrent or self.count)
+        futures = []
+        with self._longRunning() as executor:
+            for scint in self.scints:
+                if scint.scint_channel in failed:
+                    futures.append(None)
+                    continue
+                slots.acquire()
+                future = self._submitTo(executor, scint, level, deadline, ramping.powerOnChannel, scint, **kwargs)
+                future.add_done_callback(lambda future: slots.release())
+                futures.append(future)
+            results, errors = self._collect(futures)
+        errors.update(failed)
+        return results, errors
+
+    def close(self):
+        """Close all serial ports"""
+        if self.workers is not None:
+            self.workers.stop()     # the workers close their ports, they are started again on use
+            return
+        for scint in self.scints:
+            scint.close()
+
+    def startWatchdogs(self, max_current, max_voltage = None, rate = 20., **kwargs):
+        """Guard every channel with a Watchdog polling in its own thread"""
+        self.stopWatchdogs()
+        self.watchdogs = [Watchdog(scint, max_current, max_voltage=max_voltage, rate=rate, **kwargs) for scint in self.scints]
+        for watchdog in self.watchdogs:
+            watchdog.start()
+        return self.watchdogs
+
+    def stopWatchdogs(self):
+        """Stop all watchdogs"""
+        for watchdog in self.watchdogs:
+            watchdog.stop()
+        self.watchdogs = []
 
+    def help(self):
+        """Display help message"""
+        print(Scintillators.__doc__)
+        print("\nYou can use the following methods from the Scintillator class in runMethod():\n")
+        print(Scintillator.__doc__)
+
+    # -- private methods --
+
+    def _fanOut(self, method, *args, **kwargs):
+        """Call a Scintillator method on every channel at once, returning (results in channel order, errors by channel)"""
+        # the pool threads send with the caller's priority class
+        level, deadline = scheduler.currentPriority()
+        futures = [self._submit(scint, level, deadline, getattr(scint, method), *args, **kwargs)
+                   for scint in self.scints]
+        return self._collect(futures)
+
+    def _takeSnapshot(self):
+        """Read the status of all channels, returning (StatusSnapshot, errors by channel) without touching errors"""
+        timestamp = time.time()
+        records, errors = self._fanOut("getStatusRecord")
+        return StatusSnapshot.fromRecords(records, [scint.scint_channel for scint in self.scints], self.ports, timestamp), errors
+
+    def _collect(self, futures):
+        """Wait for one future (or None for a skipped channel) per channel, returning (results, errors by channel)"""
+        results = []
+        errors = {}
+        for scint, future in zip(self.scints, futures):
+            try:
+                results.append(None if future is None else future.result())
+            except Exception as e:
+                results.append(None)
+                errors[scint.scint_channel] = e
+        return results, errors
+
+    def _longRunning(self):
+        """A thread pool of its own for ramps and power-ons, so they do not take the threads of the shared pool"""
+        return ThreadPoolExecutor(max_workers=max(1, self.count), thread_name_prefix="scint-ramp")
+
+    def _submit(self, scint, level, deadline, function, *args, **kwargs):
+        """Run function on the pool for a channel with the caller's priority class"""
+        return self._submitTo(self._executor, scint, level, deadline, function, *args, **kwargs)
+
+    def _submitTo(self, executor, scint, level, deadline, function, *args, **kwargs):
+        """Run function on executor for a channel with the caller's priority class"""
+        def call():
+            with scheduler.priority(level, deadline):
+                return function(*args, **kwargs)
+        return executor.submit(call)
+
+    @staticmethod
+    def _checkMethod(method):
+        """Raise AttributeError unless method names a public Scintillator method"""
+        if method.startswith("_") or not callable(getattr(Scintillator, method, None)):
+            raise AttributeError(f"Class 'Scintillator' does not have method '{method}'")
+
+    @staticmethod
+    def _pivotStatus(singleScintStatuses):
+        """Turn a list of per-channel status dicts into a dict of per-key lists"""
+        return pivot(singleScintStatuses)
+
+    @staticmethod
+    def _formatStatus(status_dict):
+        """Format a dict of per-key status lists as a table"""
+        if not status_dict:
+            return "No scintillator channel status\n"
         # formatting, keep track of longest names in each column
         customTab = " "*4
         tabLen = len(customTab)
@@ -120,23 +388,4 @@ class Scintillators():
                 status_msg += "-"*(maxChar+tabLen*2) + '+'
             status_msg += "-\n"
                 
-        print(status_msg)
-    
-    def runMethod(self, method, *args, **kwargs):
-        """Run a Scintillator method for all scintillators"""
-        for scint in self.scints:
-            try:
-                scintMethod = getattr(scint, method)
-                scintMethod(*args, **kwargs)
-                print(f"Command successfully sent to Scintillator {scint.scint_channel}")
-            except AttributeError:
-                raise AttributeError(f"Class 'Scintillator' does not have method '{method}'")
-            except Exception as e:
-                print(f'Scintillator {scint.scint_channel} raised an error: {e}')
-                pass
-
-    def help(self):
-        """Display help message"""
-        print(Scintillators.__doc__)
-        print("\nYou can use the following methods from the Scintillator class in runMethod():\n")
-        print(Scintillator.__doc__)
\ No newline at end of file
+        return status_msg
@@ -0,0 +1,326 @@
+"""This file defines a software stand-in for the scintillator microcontroller on a pseudo-terminal"""
+import math
+import os
+import pty
+import random
+import select
+import sys
+import threading
+import time
+import tty
+from utils import conversions
+from utils import frames
+
+class FakeMicrocontroller():
+    """
+    FakeMicrocontroller
+
+    Simulates one scintillator channel: the microcontroller text shell ("pmt HPO", "pmt HON",
+    "pmt HOF", "pmt HBV<hex>", "pmt HGV", ..., "status") and the framed STX/cmd/data/ETX/checksum/CR
+    protocol of the HV chip, served on a pseudo-terminal. Scintillator(serial_port=fake.port) talks to
+    it unchanged.
+
+    Text shell replies echo the command line, print a fixed banner and then the HV chip frame followed
+    by a prompt, as the hardware does.
+
+    Pseudo-terminals do not accept parity settings, so open the port with the default parity.
+
+    The output voltage follows the set voltage with a first order response while HV is on, and the
+    current is proportional to the output voltage.
+
+    Parameters
+    ----------
+    latency : float
+        Seconds between receiving a complete command and starting the reply. Default 0.02.
+    jitter : float
+        Upper bound in seconds of a uniformly distributed delay added to latency. Default 0.
+    corruption : float
+        Probability that any single reply byte is replaced by a random byte. Default 0.
+    dead : bool
+        If True, the channel never replies, like an unconnected channel. Default False.
+    baud_rate : int or None
+        If given, replies are paced to the transmission time of this baud rate (10 bits per byte).
+        Default 9600.
+    settle_time : float
+        Time constant in seconds of the output voltage following the set voltage. Default 0.05.
+    current_per_volt : float
+        Output current in uA per volt of output voltage. Default 0.4.
+    temperature : float
+        Reported temperature in degrees C. Default 25.
+    seed : int or None
+        Seed for the random number generator used for jitter and corruption.
+
+    Attributes
+    ----------
+    port
+        The path of the pseudo-terminal to open with Serial
+    latency, jitter, corruption, dead, baud_rate, settle_time, current_per_volt, temperature
+        As given, may be changed while running
+    extra_current
+        Additional output current in uA, e.g. to provoke an overcurrent. Default 0.
+    hv_on
+        Whether high voltage is on
+    vo_set
+        The set output voltage in V
+    commands
+        The number of commands received
+
+    Methods
+    -------
+    start()
+        Start serving the pseudo-terminal in a background thread (done on construction)
+    stop()
+        Stop serving and close the pseudo-terminal
+    vo_mon()
+        The current simulated output voltage in V
+    io_mon()
+        The current simulated output current in uA
+
+    """
+
+    _banner = f"{'pmt: forwarding command to HV chip':<84}\r\n".encode("ascii")
+    _prompt = b"\r\n> "
+    _currentLimit = 100.    # uA, above this the current is out of specification
+
+    def __init__(self, latency = .02, jitter = 0, corruption = 0, dead = False, baud_rate = 9600,
+                 settle_time = .05, current_per_volt = .4, temperature = 25., seed = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.corruption = corruption
+        self.dead = dead
+        self.baud_rate = baud_rate
+        self.settle_time = settle_time
+        self.current_per_volt = current_per_volt
+        self.temperature = temperature
+        self.extra_current = 0.
+        self.hv_on = False
+        self.vo_set = 0.
+        self.commands = 0
+        self._random = random.Random(seed)
+        self._temperatureCorrection = [0x03e8, 0x03e8, 0, 0, 0, 0]
+        self._vo_start = 0.
+        self._change_time = time.monotonic()
+        self._stopped = threading.Event()
+
+        self._master, slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(slave)
+        self._slave = slave
+        self.port = os.ttyname(slave)
+        self._thread = None
+        self.start()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._serve, name=f"fake-{self.port}", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def vo_mon(self):
+        target = self.vo_set if self.hv_on else 0.
+        if self.settle_time <= 0:
+            return target
+        elapsed = time.monotonic() - self._change_time
+        return target + (self._vo_start - target) * math.exp(-elapsed / self.settle_time)
+
+    def io_mon(self):
+        return self.vo_mon() * self.current_per_volt + self.extra_current
+
+    # -- private methods --
+
+    def _serve(self):
+        buffer = b""
+        while not self._stopped.is_set():
+            readable, _, _ = select.select([self._master], [], [], .1)
+            if not readable:
+                continue
+            try:
+                buffer += os.read(self._master, 1024)
+            except OSError:
+                return
+            buffer = self._handle(buffer)
+
+    def _handle(self, buffer):
+        #Answers every complete command in buffer and returns the incomplete rest.
+        #A dead channel neither executes nor answers them, like an unconnected one.
+        while True:
+            if buffer.startswith(b"\x02"):
+                etx = buffer.find(b"\x03")
+                if etx < 0 or len(buffer) < etx + 4:
+                    return buffer
+                frame, buffer = buffer[:etx+4], buffer[etx+4:]
+                self._reply(None if self.dead else self._frameReply(frame))
+            elif b"\r" in buffer:
+                line, buffer = buffer.split(b"\r", 1)
+                line = line.lstrip(b"\n")
+                if line:
+                    self._reply(None if self.dead else self._shellReply(line))
+            else:
+                return buffer
+
+    def _reply(self, reply):
+        self.commands += 1
+        if reply is None or self.dead:
+            return
+        time.sleep(self.latency + self._random.uniform(0, self.jitter))
+        if self.corruption:
+            reply = bytes(self._random.randrange(256) if self._random.random() < self.corruption else byte
+                          for byte in reply)
+        if self.baud_rate:
+            time.sleep(len(reply) * 10 / self.baud_rate)
+        try:
+            os.write(self._master, reply)
+        except OSError:
+            pass
+
+    def _shellReply(self, line):
+        echo = line + b"\r\n"
+        text = line.decode("ascii", "replace")
+        if text == "status":
+            state = "hv on" if self.hv_on else "hv off"
+            return echo + f"{'running':<9}\r\n{state:<8}".encode("ascii") + self._prompt
+        if text.startswith("pmt ") and len(text) >= 7:
+            cmd = text[4:7].lower()
+            return echo + self._banner + self._execute(cmd, text[7:]) + self._prompt
+        return echo + b"unknown command" + self._prompt
+
+    def _frameReply(self, frame):
+        if frame[-1:] != b"\r" or frame[-4:-3] != b"\x03":
+            return self._frame("hxx", [3])
+        try:
+            received = int(frame[-3:-1], 16)
+        except ValueError:
+            return self._frame("hxx", [3])
+        if sum(frame[:-3]) & 0xff != received:
+            return self._frame("hxx", [4])
+        return self._execute(frame[1:4].decode("ascii", "replace").lower(), frame[4:-4].decode("ascii", "replace"))
+
+    def _execute(self, cmd, data):
+        #Runs a HV chip command and returns the reply frame
+        if cmd not in frames.DATA_SIZES or cmd == "hxx":
+            return self._frame("hxx", [5])
+        try:
+            values = [int(data[i:i+4], 16) for i in range(0, len(data), 4)]
+        except ValueError:
+            return self._frame("hxx", [6])
+        if cmd == "hon":
+            self._change(True, self.vo_set)
+        elif cmd == "hof":
+            self._change(False, self.vo_set)
+        elif cmd == "hbv":
+            if len(values) != 1:
+                return self._frame("hxx", [7])
+            self._change(self.hv_on, conversions.fromCode(values[0], "voltage"))
+        elif cmd == "hst":
+            if len(values) != 6:
+                return self._frame("hxx", [7])
+            self._temperatureCorrection = values
+        elif cmd == "hpo":
+            return self._frame(cmd, [self._status(), self._code(self.vo_set, "voltage"),
+                                     self._code(self.vo_mon(), "voltage"),
+                                     self._code(self.io_mon(), "current"), self._temperatureCode()])
+        elif cmd == "hgv":
+            return self._frame(cmd, [self._code(self.vo_mon(), "voltage")])
+        elif cmd == "hgc":
+            return self._frame(cmd, [self._code(self.io_mon(), "current")])
+        elif cmd == "hgt":
+            return self._frame(cmd, [self._temperatureCode()])
+        elif cmd == "hgs":
+            return self._frame(cmd, [self._status()])
+        elif cmd == "hrc":
+            return self._frame(cmd, [0])
+        if cmd in ("hrt", "hst"):
+            return self._frame(cmd, self._temperatureCorrection)
+        return self._frame(cmd, [])
+
+    def _change(self, hv_on, vo_set):
+        self._vo_start = self.vo_mon()
+        self._change_time = time.monotonic()
+        self.hv_on = hv_on
+        self.vo_set = vo_set
+
+    def _status(self):
+        status = 1 if self.hv_on else 0
+        if self.io_mon() > self._currentLimit:
+            status |= 4
+        return status
+
+    def _code(self, value, kind):
+        return conversions.toCode(value, kind, rounding="nearest")
+
+    def _temperatureCode(self):
+        return self._code(self.temperature, "temperature")
+
+    def _frame(self, cmd, values):
+        line = b"\x02" + cmd.encode("ascii") + b"".join(b"%04X" % value for value in values) + b"\x03"
+        return line + b"%02X" % (sum(line) & 0xff) + b"\r"
+
+
+class SimulatedCrate():
+    """
+    SimulatedCrate
+
+    A set of FakeMicrocontroller channels, e.g. for Scintillators(number_of_scints=crate.count,
+    serial_ports=crate.ports). Can be used as a context manager that stops all channels on exit.
+
+    Parameters
+    ----------
+    number_of_channels : int
+        The number of simulated channels
+    dead_channels : list[int]
+        Channel numbers (starting at 1) that never reply
+    **kwargs
+        Passed to every FakeMicrocontroller
+
+    Attributes
+    ----------
+    count : int
+        The number of simulated channels
+    channels : list[FakeMicrocontroller]
+        The simulated channels
+    ports : list[str]
+        The pseudo-terminal paths of the channels
+
+    Methods
+    -------
+    stop()
+        Stop all channels
+
+    """
+
+    def __init__(self, number_of_channels = 4, dead_channels = (), **kwargs):
+        self.count = number_of_channels
+        self.channels = [FakeMicrocontroller(dead=(i+1) in dead_channels, **kwargs) for i in range(number_of_channels)]
+        self.ports = [channel.port for channel in self.channels]
+
+    def stop(self):
+        for channel in self.channels:
+            channel.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    # python3 -m utils.simulator [number of channels] serves a simulated crate until interrupted
+    crate = SimulatedCrate(int(sys.argv[1]) if len(sys.argv) > 1 else 4)
+    for i, port in enumerate(crate.ports):
+        print(f"Scintillator {i+1}: {port}", flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        crate.stop()
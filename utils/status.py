@@ -0,0 +1,183 @@
+"""This file defines the compact status record of a scintillator channel and the NumPy snapshot of many channels"""
+import time
+import numpy as np
+
+# channel states, in the order of their codes in a snapshot; "error" marks a channel whose query raised
+STATES = ["ok", "not detected", "unavailable", "error"]
+# HV status flags decoded from the HPO status word: (key, bit mask, whether a set bit means True)
+FLAGS = [
+    ("high_voltage_on", 1, True),
+    ("overcurrent_protection", 2, True),
+    ("current_in_specification", 4, False),
+    ("sensor_connected", 8, False),
+    ("sensor_in_specification", 16, False),
+    ("temperature_conversion_effective", 64, False),
+]
+# converted HPO values
+VALUES = ["vo_set", "vo_mon", "io_mon", "T_mon"]
+# one row of a snapshot; values are NaN and flags False for channels that are not "ok"
+STATUS_DTYPE = np.dtype(
+    [("channel", np.int16), ("state", np.uint8), ("status", np.uint16)]
+    + [(key, np.bool_) for key, _, _ in FLAGS]
+    + [(key, np.float64) for key in VALUES]
+)
+
+def hvFlags(status):
+    """The HV status flags (see FLAGS) of an HPO/HGS status word"""
+    return {key: ((status & mask) != 0) == set_means for key, mask, set_means in FLAGS}
+
+def pivot(statuses):
+    """Turn a list of per-channel status dicts into a dict of per-key lists, None for channels without a status"""
+    # channels that raised get an empty column
+    keys = next((status.keys() for status in statuses if status is not None), [])
+    return {key: [None if status is None else status.get(key) for status in statuses] for key in keys}
+
+
+class StatusRecord():
+    """
+    StatusRecord
+
+    The status of one channel from one HPO query, kept as the raw status word and the four converted
+    values instead of a dict of a dozen keys. Records are shared between callers of a cached status,
+    so they must not be modified.
+
+    Parameters
+    ----------
+    channel : int
+        The channel number
+    port : str
+        The serial port path of the channel
+    state : str
+        One of STATES
+    status : int or None
+        The HPO status word, None unless state is "ok"
+    vo_set, vo_mon, io_mon, T_mon : float or None
+        The converted HPO values, None unless state is "ok"
+
+    Methods
+    -------
+    flags()
+        The HV status flags (see FLAGS); -1 if the channel was not detected, None if unavailable
+    asDict()
+        The status dict Scintillator.getStatus returns
+
+    """
+
+    __slots__ = ("channel", "port", "state", "status", "vo_set", "vo_mon", "io_mon", "T_mon")
+
+    def __init__(self, channel, port, state, status = None, vo_set = None, vo_mon = None, io_mon = None, T_mon = None):
+        self.channel = channel
+        self.port = port
+        self.state = state
+        self.status = status
+        self.vo_set = vo_set
+        self.vo_mon = vo_mon
+        self.io_mon = io_mon
+        self.T_mon = T_mon
+
+    def __repr__(self):
+        return f"StatusRecord(channel={self.channel}, state={self.state!r}, vo_mon={self.vo_mon}, io_mon={self.io_mon})"
+
+    def flags(self):
+        if self.state == "ok":
+            return hvFlags(self.status)
+        return dict.fromkeys((key for key, _, _ in FLAGS), self._missing())
+
+    def asDict(self):
+        status_dict = {"channel": self.channel, "serial port": self.port, "state": self.state}
+        if self.state != "ok":
+            status_dict["HV set"] = None
+        status_dict.update(self.flags())
+        missing = self._missing()
+        for key in VALUES:
+            value = getattr(self, key)
+            status_dict[key] = missing if value is None else value
+        return status_dict
+
+    # -- private methods --
+
+    def _missing(self):
+        #Value of a quantity that was not read: -1 if the channel was not detected, None otherwise
+        return -1 if self.state == "not detected" else None
+
+
+class StatusSnapshot():
+    """
+    StatusSnapshot
+
+    The status of many channels taken at one time, as a NumPy structured array with one row per
+    channel (see STATUS_DTYPE), so analysis can work on whole columns without Python objects.
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+        The rows, of dtype STATUS_DTYPE
+    ports : list[str]
+        The serial port path of each row
+    timestamp : float or None
+        The time the snapshot was taken (time.time()). Default now.
+
+    Attributes
+    ----------
+    array : numpy.ndarray
+        The rows
+    ports : list[str]
+        The serial port path of each row
+    timestamp : float
+        The time the snapshot was taken
+
+    Methods
+    -------
+    fromRecords(records, channels, ports, timestamp=None)
+        Class method building a snapshot from StatusRecords; a None record gives an "error" row
+    ok()
+        Boolean mask of the rows whose state is "ok"
+    records()
+        The rows as StatusRecords, None for "error" rows
+    asDict()
+        The dict of per-key lists Scintillators.status returns
+
+    """
+
+    def __init__(self, array, ports, timestamp = None):
+        self.array = array
+        self.ports = list(ports)
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+    @classmethod
+    def fromRecords(cls, records, channels, ports, timestamp = None):
+        array = np.zeros(len(records), dtype=STATUS_DTYPE)
+        array["channel"] = channels
+        array["state"] = [STATES.index("error" if record is None else record.state) for record in records]
+        for key in VALUES:
+            array[key] = [np.nan if record is None or record.state != "ok" else getattr(record, key) for record in records]
+        array["status"] = [record.status if record is not None and record.state == "ok" else 0 for record in records]
+        ok = array["state"] == STATES.index("ok")
+        for key, mask, set_means in FLAGS:
+            array[key] = ok & (((array["status"] & mask) != 0) == set_means)
+        return cls(array, ports, timestamp)
+
+    def ok(self):
+        return self.array["state"] == STATES.index("ok")
+
+    def records(self):
+        records = []
+        for row, port in zip(self.array.tolist(), self.ports):
+            channel, state, status = row[0], STATES[row[1]], row[2]
+            if state == "error":
+                records.append(None)
+            elif state == "ok":
+                values = row[len(STATUS_DTYPE.names)-len(VALUES):]
+                records.append(StatusRecord(channel, port, state, status, *values))
+            else:
+                records.append(StatusRecord(channel, port, state))
+        return records
+
+    def asDict(self):
+        return pivot([None if record is None else record.asDict() for record in self.records()])
@@ -0,0 +1,222 @@
+"""This file defines the append-only columnar store that keeps the telemetry history of scintillator channels on disk"""
+import json
+import os
+import threading
+import time
+import numpy as np
+
+# stored columns and their on-disk (little endian) types, one file each per channel and day
+COLUMNS = [
+    ("time", np.dtype("<f8")),
+    ("state", np.dtype("u1")),
+    ("status", np.dtype("<u2")),
+    ("vo_set", np.dtype("<f8")),
+    ("vo_mon", np.dtype("<f8")),
+    ("io_mon", np.dtype("<f8")),
+    ("T_mon", np.dtype("<f8")),
+]
+# file of a segment holding the number of committed rows
+HEADER = "rows.json"
+
+
+class TelemetryStore():
+    """
+    TelemetryStore
+
+    Keeps the status history of every channel in fixed-width binary columns (see COLUMNS) on disk,
+    one segment directory per UTC day and channel: <directory>/<YYYY-MM-DD>/channel<NNN>/<column>.bin.
+    Rows are only ever appended. A segment's header holds the number of committed rows and is
+    replaced atomically once the columns have been synced, so after a crash readers see every
+    committed row and nothing else, and the writer drops the partial rows when it reopens the segment.
+    Readback memory-maps the columns, so reading one channel touches only that channel's files.
+    There must be only one writer per directory; readers may be in other processes.
+
+    Parameters
+    ----------
+    directory : str
+        The root directory of the store, created if needed
+    flush_interval : float
+        Seconds between commits of the appended rows; rows appended since the last commit are lost
+        in a crash. 0 commits every append. Default 10.
+
+    Methods
+    -------
+    append(snapshot)
+        Append one row per channel of a StatusSnapshot (see utils.status), timed by its timestamp
+    flush()
+        Commit the rows appended so far
+    close()
+        Commit and close the open segments
+    channels()
+        The channel numbers in the store
+    days(channel=None)
+        The days ('YYYY-MM-DD') with data, of one channel or any channel
+    read(channel, start=None, end=None, columns=None)
+        A dict of column arrays of a channel's committed rows with start <= time < end (seconds since
+        the epoch, default unbounded). A range within one day gives read-only memory-mapped views,
+        a range over several days is copied into one array per column.
+
+    """
+
+    def __init__(self, directory, flush_interval = 10.):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+        self._segments = {}     # channel -> _Segment of the current day
+        self._lastFlush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def append(self, snapshot):
+        day = _day(snapshot.timestamp)
+        with self._lock:
+            for row in snapshot.array:
+                channel = int(row["channel"])
+                segment = self._segments.get(channel)
+                if segment is None or segment.day != day:
+                    if segment is not None:
+                        segment.close()
+                    segment = self._segments[channel] = _Segment(self._segmentPath(day, channel), day)
+                segment.append(snapshot.timestamp, row)
+            if time.monotonic() - self._lastFlush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments = {}
+
+    def channels(self):
+        return sorted({int(name[len("channel"):]) for day in self.days() for name in self._listdir(os.path.join(self.directory, day))
+                       if name.startswith("channel")})
+
+    def days(self, channel = None):
+        days = sorted(name for name in self._listdir(self.directory) if _isDay(name))
+        if channel is None:
+            return days
+        return [day for day in days if os.path.isdir(self._segmentPath(day, channel))]
+
+    def read(self, channel, start = None, end = None, columns = None):
+        names = [name for name, _ in COLUMNS] if columns is None else list(columns)
+        first = None if start is None else _day(start)
+        last = None if end is None else _day(end)
+        parts = []
+        for day in self.days(channel):
+            if (first is not None and day < first) or (last is not None and day > last):
+                continue
+            part = _readSegment(self._segmentPath(day, channel), names, start, end)
+            if part is not None:
+                parts.append(part)
+        if len(parts) == 1:
+            return parts[0]
+        dtypes = dict(COLUMNS)
+        return {name: np.concatenate([part[name] for part in parts]) if parts else np.empty(0, dtypes[name])
+                for name in names}
+
+    # -- private methods --
+
+    def _flush(self):
+        for segment in self._segments.values():
+            segment.commit()
+        self._lastFlush = time.monotonic()
+
+    def _segmentPath(self, day, channel):
+        return os.path.join(self.directory, day, f"channel{channel:03d}")
+
+    def _listdir(self, path):
+        try:
+            return os.listdir(path)
+        except FileNotFoundError:
+            return []
+
+
+class _Segment():
+    #Append side of one channel's columns for one day
+
+    def __init__(self, path, day):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.day = day
+        self.rows = _committedRows(path)
+        self.pending = 0
+        self._files = {}
+        for name, dtype in COLUMNS:
+            column = open(os.path.join(path, f"{name}.bin"), "ab")
+            column.truncate(self.rows * dtype.itemsize)     # drop rows written after the last commit
+            self._files[name] = column
+
+    def append(self, timestamp, row):
+        for name, dtype in COLUMNS:
+            value = timestamp if name == "time" else row[name]
+            self._files[name].write(np.asarray(value, dtype=dtype).tobytes())
+        self.pending += 1
+
+    def commit(self):
+        #The columns reach the disk before the header counts their rows
+        if not self.pending:
+            return
+        for column in self._files.values():
+            column.flush()
+            os.fsync(column.fileno())
+        self.rows += self.pending
+        self.pending = 0
+        _writeHeader(self.path, self.rows)
+
+    def close(self):
+        self.commit()
+        for column in self._files.values():
+            column.close()
+        self._files = {}
+
+
+def _day(timestamp):
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+def _isDay(name):
+    try:
+        time.strptime(name, "%Y-%m-%d")
+    except ValueError:
+        return False
+    return True
+
+def _committedRows(path):
+    try:
+        with open(os.path.join(path, HEADER)) as header:
+            return int(json.load(header)["rows"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+
+def _writeHeader(path, rows):
+    #Writes the header to a temporary file first, so readers see the old or the new count, never a partial one
+    temporary = os.path.join(path, f"{HEADER}.tmp")
+    with open(temporary, "w") as header:
+        json.dump({"rows": rows, "columns": {name: dtype.str for name, dtype in COLUMNS}}, header)
+        header.flush()
+        os.fsync(header.fileno())
+    os.replace(temporary, os.path.join(path, HEADER))
+    directory = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+def _readSegment(path, names, start, end):
+    #Memory-maps the committed rows of a segment and returns the columns of the rows in [start, end), or None
+    rows = _committedRows(path)
+    if not rows:
+        return None
+    dtypes = dict(COLUMNS)
+    times = np.memmap(os.path.join(path, "time.bin"), dtype=dtypes["time"], mode="r", shape=(rows,))
+    first = 0 if start is None else np.searchsorted(times, start, side="left")
+    last = rows if end is None else np.searchsorted(times, end, side="left")
+    if first >= last:
+        return None
+    columns = {}
+    for name in names:
+        column = times if name == "time" else np.memmap(os.path.join(path, f"{name}.bin"), dtype=dtypes[name], mode="r", shape=(rows,))
+        columns[name] = column[first:last]
+    return columns
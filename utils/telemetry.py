@@ -0,0 +1,223 @@
+"""This file defines a background telemetry poller that keeps scintillator status history in NumPy ring buffers"""
+import threading
+import time
+import numpy as np
+from utils import scheduler
+from utils.status import STATES
+
+# status quantities recorded per channel, in column order
+QUANTITIES = [
+    "vo_set",
+    "vo_mon",
+    "io_mon",
+    "T_mon",
+    "high_voltage_on",
+    "overcurrent_protection",
+    "current_in_specification",
+    "sensor_connected",
+    "sensor_in_specification",
+    "temperature_conversion_effective",
+]
+
+
+class RingBuffer():
+    """
+    RingBuffer
+
+    Fixed-size, preallocated history of samples with one row per sample. Every row is written twice,
+    at its slot and at its slot plus capacity, so the most recent rows always form one contiguous
+    block and last(n) and window(seconds) return views without copying. Appending is O(1).
+
+    Parameters
+    ----------
+    capacity : int
+        The number of samples kept
+    shape : tuple
+        The shape of one sample, e.g. (channels, quantities)
+    dtype
+        The NumPy dtype of the samples. Default float64; float rows are initialized to NaN.
+
+    Attributes
+    ----------
+    capacity : int
+        The number of samples kept
+    count : int
+        The total number of samples appended so far
+
+    Methods
+    -------
+    append(timestamp, sample)
+        Add a sample, overwriting the oldest one when full
+    last(n)
+        Views (times, samples) of the most recent n samples, oldest first
+    window(seconds, now=None)
+        Views (times, samples) of the samples taken in the last seconds
+    latest()
+        The most recent (time, sample), or None if empty
+
+    """
+
+    def __init__(self, capacity, shape = (), dtype = np.float64):
+        self.capacity = int(capacity)
+        self.count = 0
+        self._times = np.full(2*self.capacity, np.nan)
+        self._samples = np.empty((2*self.capacity,) + tuple(shape), dtype=dtype)
+        if np.issubdtype(self._samples.dtype, np.floating):
+            self._samples.fill(np.nan)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, sample):
+        with self._lock:
+            slot = self.count % self.capacity
+            self._times[slot] = self._times[slot+self.capacity] = timestamp
+            self._samples[slot] = self._samples[slot+self.capacity] = sample
+            self.count += 1
+
+    def last(self, n = None):
+        with self._lock:
+            size = len(self)
+            n = size if n is None else max(0, min(int(n), size))
+            end = (self.count-1) % self.capacity + self.capacity + 1 if self.count else self.capacity
+        return self._times[end-n:end], self._samples[end-n:end]
+
+    def window(self, seconds, now = None):
+        times, samples = self.last()
+        now = time.time() if now is None else now
+        start = np.searchsorted(times, now - seconds, side="left")
+        return times[start:], samples[start:]
+
+    def latest(self):
+        times, samples = self.last(1)
+        if not len(times):
+            return None
+        return times[0], samples[0]
+
+
+class TelemetryPoller():
+    """
+    TelemetryPoller
+
+    Samples the status of every channel of a Scintillators instance from a background thread at a
+    fixed rate into a RingBuffer with one row per sample and one column per channel and quantity
+    (see QUANTITIES). Boolean status bits are stored as 1/0, channels that were not detected give -1
+    and channels that raised give NaN. Samples are read in the 'monitoring' priority class, so they
+    wait behind operator and safety commands and are dropped once stale (DeadlineExceeded in errors).
+
+    Parameters
+    ----------
+    scints : Scintillators
+        The scintillator channels to sample
+    rate : float
+        Samples per second. Default 1.
+    capacity : int
+        The number of samples kept. Default 3600.
+    quantities : list[str]
+        The status keys to record. Default QUANTITIES.
+    store : TelemetryStore or None
+        If given, every sample is also appended to this on-disk store (see utils.store), which is
+        flushed when sampling stops.
+
+    Attributes
+    ----------
+    buffer : RingBuffer
+        The history, samples of shape (channels, quantities)
+    quantities : list[str]
+        The recorded status keys, in column order
+    channels : list[int]
+        The channel numbers, in column order
+    errors : dict
+        The exceptions of the last sample, keyed by scint channel
+
+    Methods
+    -------
+    start()
+        Start sampling in a background thread
+    stop()
+        Stop sampling
+    sample()
+        Take one sample now
+    latest()
+        The latest (time, sample) snapshot
+    window(seconds)
+        Views (times, samples) of the last seconds of history
+    series(quantity, channel=None, seconds=None)
+        View of one quantity for one channel (or all channels) over the last seconds (or all history)
+
+    """
+
+    def __init__(self, scints, rate = 1., capacity = 3600, quantities = QUANTITIES, store = None):
+        self.scints = scints
+        self.store = store
+        self.rate = rate
+        self.quantities = list(quantities)
+        self.channels = [scint.scint_channel for scint in scints.scints]
+        self.buffer = RingBuffer(capacity, (len(self.channels), len(self.quantities)))
+        self.errors = {}
+        self._row = np.empty((len(self.channels), len(self.quantities)))
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.store is not None:
+            self.store.flush()
+
+    def sample(self):
+        timestamp = time.time()
+        with scheduler.priority("monitoring"):
+            # errors of its own call, the shared Scintillators.errors belongs to the other callers
+            snapshot, self.errors = self.scints._takeSnapshot()
+        rows = snapshot.array
+        state = rows["state"]
+        for col, quantity in enumerate(self.quantities):
+            if quantity in rows.dtype.names:
+                self._row[:, col] = rows[quantity]
+            else:
+                self._row[:, col] = np.nan
+        self._row[state == STATES.index("not detected")] = -1
+        self._row[state >= STATES.index("unavailable")] = np.nan
+        self.buffer.append(timestamp, self._row)
+        if self.store is not None:
+            self.store.append(snapshot)
+
+    def latest(self):
+        return self.buffer.latest()
+
+    def window(self, seconds):
+        return self.buffer.window(seconds)
+
+    def series(self, quantity, channel = None, seconds = None):
+        times, samples = self.buffer.last() if seconds is None else self.buffer.window(seconds)
+        col = self.quantities.index(quantity)
+        if channel is None:
+            return times, samples[:, :, col]
+        return times, samples[:, self.channels.index(channel), col]
+
+    # -- private methods --
+
+    def _run(self):
+        period = 1. / self.rate
+        next_time = time.monotonic()
+        while not self._stopped.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                self.errors = {"poller": e}
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay < 0:   # fell behind, skip the missed samples instead of bursting
+                next_time = time.monotonic()
+                delay = 0
+            self._stopped.wait(delay)
@@ -0,0 +1,149 @@
+"""This file defines the overcurrent/overvoltage watchdog that turns a channel's high voltage off"""
+import threading
+import time
+
+class Watchdog():
+    """
+    Watchdog
+
+    Polls the output current (HGC), the HV status flags (HGS) and optionally the output voltage (HGV)
+    of one Scintillator from a background thread at a high rate, and sends HV_Off as soon as a limit
+    is crossed. Polls and the trip are sent in the 'safety' priority class (Scintillator.urgent()), so
+    they never wait behind more than the one command (e.g. of a status sweep) already on the port.
+    The watchdog only counts as tripped once the HV chip has acknowledged HV_Off; until then every
+    check sends HV_Off again.
+
+    Parameters
+    ----------
+    scint : Scintillator
+        The channel to guard
+    max_current : float
+        Trip above this output current in uA
+    max_voltage : float or None
+        Trip above this output voltage in V. If None (default), the voltage is not polled.
+    rate : float
+        Polls per second. Default 20.
+    trip_on_status : bool
+        Also trip if the chip reports overcurrent protection or a current out of specification. Default True.
+    on_trip : callable or None
+        Called with the Watchdog after a trip
+
+    Attributes
+    ----------
+    tripped : bool
+        Whether the watchdog has tripped since the last reset
+    trip_reason : str or None
+        Why it tripped
+    trip_time : float or None
+        time.time() when the crossing was detected
+    time_to_trip : float or None
+        Seconds from the start of the poll that saw the crossing until HV_Off was acknowledged
+    polls : int
+        The number of polls done
+    errors : int
+        The number of polls that raised, e.g. because the channel did not reply
+    last_error : Exception or None
+        The exception of the last failed poll
+
+    Methods
+    -------
+    start()
+        Start polling in a background thread
+    stop()
+        Stop polling
+    check()
+        Poll once and trip if a limit is crossed, returns whether it tripped
+    reset()
+        Clear the trip so the watchdog guards the channel again
+
+    """
+
+    def __init__(self, scint, max_current, max_voltage = None, rate = 20., trip_on_status = True, on_trip = None):
+        self.scint = scint
+        self.max_current = max_current
+        self.max_voltage = max_voltage
+        self.rate = rate
+        self.trip_on_status = trip_on_status
+        self.on_trip = on_trip
+        self.polls = 0
+        self.errors = 0
+        self.last_error = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self.reset()
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name=f"watchdog-{self.scint.scint_channel}", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def reset(self):
+        self.tripped = False
+        self.trip_reason = None
+        self.trip_time = None
+        self.time_to_trip = None
+        self._pendingTrip = None    # (reason, poll start) of a crossing whose HV_Off was not acknowledged yet
+
+    def check(self):
+        if self.tripped:
+            return False
+        with self.scint.urgent():
+            if self._pendingTrip is None:
+                poll_start = time.monotonic()
+                reason = self._crossing()
+                self.polls += 1
+                if reason is None:
+                    return False
+                self.trip_time = time.time()
+                self._pendingTrip = (reason, poll_start)
+            reason, poll_start = self._pendingTrip
+            self.scint.HV_Off()     # raises without an acknowledgement, the next check sends it again
+        self._pendingTrip = None
+        self.time_to_trip = time.monotonic() - poll_start
+        self.tripped = True
+        self.trip_reason = reason
+        if self.on_trip is not None:
+            self.on_trip(self)
+        return True
+
+    # -- private methods --
+
+    def _crossing(self):
+        #Returns the reason to trip, or None if all limits are kept
+        current = self.scint.getOutputCurrent()
+        if current > self.max_current:
+            return f"Output current {current:.3f} uA above {self.max_current} uA"
+        if self.trip_on_status:
+            status = self.scint.getChipStatus()
+            if status["overcurrent_protection"]:
+                return "Overcurrent protection active"
+            if not status["current_in_specification"]:
+                return "Output current out of specification"
+        if self.max_voltage is not None:
+            voltage = self.scint.getOutputVoltage()
+            if voltage > self.max_voltage:
+                return f"Output voltage {voltage:.3f} V above {self.max_voltage} V"
+        return None
+
+    def _run(self):
+        period = 1. / self.rate
+        next_time = time.monotonic()
+        while not self._stopped.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay < 0:   # fell behind, poll again right away
+                next_time = time.monotonic()
+                delay = 0
+            self._stopped.wait(delay)
@@ -0,0 +1,354 @@
+"""This file defines worker processes that run scintillator channels in isolation, and their supervisor"""
+from concurrent.futures import Future, ThreadPoolExecutor
+import itertools
+import multiprocessing
+import pickle
+import threading
+import time
+from utils import scheduler
+from utils.scintillator import Scintillator
+
+# started from a clean server process, so forking a worker never copies the parent's threads and locks
+_context = multiprocessing.get_context("forkserver")
+
+
+class WorkerTimeout(Exception):
+    def __init__(self, channel, name, deadline):
+        super().__init__(channel, name, deadline)
+        self.channel = channel
+        self.name = name
+        self.deadline = deadline
+
+    def __str__(self):
+        return f"Worker of scintillator channel {self.channel} did not finish {self.name} within {self.deadline:g} s, restarted"
+
+
+class WorkerDied(Exception):
+    def __init__(self, channel, name):
+        super().__init__(channel, name)
+        self.channel = channel
+        self.name = name
+
+    def __str__(self):
+        return f"Worker of scintillator channel {self.channel} exited during {self.name}, restarted"
+
+
+class WorkerStartFailed(Exception):
+    def __init__(self, channel, error):
+        super().__init__(channel, error)
+        self.channel = channel
+        self.error = error
+
+    def __str__(self):
+        return f"Worker of scintillator channel {self.channel} could not start: {self.error}"
+
+
+class WorkerError(Exception):
+    """An exception raised in a worker that could not be sent back as it was"""
+
+
+class ChannelProxy():
+    """
+    ChannelProxy
+
+    Stands in for a Scintillator that lives in a worker process. Method calls and attribute reads and
+    writes are forwarded to the worker and block until it replies, with the priority class of the
+    calling thread. priority() and urgent() are applied locally and travel with each call.
+
+    Parameters
+    ----------
+    pool : WorkerPool
+        The pool running the channel
+    scint_channel : int
+        The channel number
+    port : str
+        The serial port path of the channel
+
+    """
+
+    def __init__(self, pool, scint_channel, port):
+        self.__dict__.update(_pool=pool, scint_channel=scint_channel, port=port)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        if callable(getattr(Scintillator, name, None)):
+            return lambda *args, **kwargs: self._pool.call(self.scint_channel, "call", name, args, kwargs)
+        return self._pool.call(self.scint_channel, "get", name)
+
+    def __setattr__(self, name, value):
+        self._pool.call(self.scint_channel, "set", name, (value,))
+
+    def priority(self, level, deadline = None):
+        return scheduler.priority(level, deadline)
+
+    def urgent(self):
+        return scheduler.priority("safety")
+
+
+class WorkerPool():
+    """
+    WorkerPool
+
+    Runs scintillator channels in worker processes, one process per group of channels (e.g. per channel
+    or per hub), and talks to them over pipes. A worker handles the requests for its channels in its own
+    threads, so each port's I/O stays serialized by its PortScheduler while reply parsing of different
+    workers runs on different cores. A supervisor thread restarts a worker that has not answered a
+    request within its deadline, or that exited, and fails its outstanding requests. A worker that
+    exits before it is ready is started again after an exponentially growing delay, and calls to
+    its channels raise WorkerStartFailed with its startup error until it has started.
+
+    Parameters
+    ----------
+    groups : list[dict]
+        One dict per worker, mapping the channel numbers it runs to their Scintillator keyword arguments
+    deadline : float or None
+        Seconds a worker may take for one request before it is considered hung. Default 30.
+    poll_interval : float
+        Seconds between supervisor checks, and the delay before the first restart of a worker that
+        failed to start. Default 0.1.
+    max_backoff : float
+        The longest delay in seconds between restarts of a worker that keeps failing to start. Default 30.
+    slots : int or None
+        If given, the channels of one worker run at most this many serial commands at the same time
+        (see Scintillator hub_slot). If None (default), no limit.
+
+    Attributes
+    ----------
+    restarts : dict
+        The number of restarts of each worker, keyed by its first channel
+
+    Methods
+    -------
+    proxy(channel)
+        A ChannelProxy for a channel
+    call(channel, kind, name, args=(), kwargs=None, deadline=None)
+        Forward a method call ("call"), attribute read ("get") or write ("set") to a channel and return
+        the result. deadline defaults to the pool's deadline.
+    start()
+        Start all workers and the supervisor
+    stop()
+        Stop all workers
+
+    """
+
+    def __init__(self, groups, deadline = 30., poll_interval = .1, max_backoff = 30., slots = None):
+        self.deadline = deadline
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self._workers = [_Worker(group, slots) for group in groups]
+        self._workerOf = {channel: worker for worker in self._workers for channel in worker.group}
+        self.restarts = {worker.name: 0 for worker in self._workers}
+        self._requestIds = itertools.count()
+        self._stopped = threading.Event()
+        self._supervisor = None
+        self._lock = threading.Lock()
+
+    def proxy(self, channel):
+        return ChannelProxy(self, channel, self._workerOf[channel].group[channel].get("serial_port"))
+
+    def start(self):
+        with self._lock:
+            now = time.monotonic()
+            for worker in self._workers:
+                if not worker.alive and not worker.backingOff(now):
+                    worker.start()
+            if self._supervisor is None:
+                self._stopped.clear()
+                self._supervisor = threading.Thread(target=self._supervise, name="worker-supervisor", daemon=True)
+                self._supervisor.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._supervisor is not None:
+            self._supervisor.join()
+            self._supervisor = None
+        for worker in self._workers:
+            worker.stop()
+
+    def call(self, channel, kind, name, args = (), kwargs = None, deadline = None):
+        worker = self._workerOf[channel]
+        if not worker.alive:
+            if worker.backingOff(time.monotonic()):
+                raise WorkerStartFailed(worker.name, worker.start_error)
+            self.start()
+        deadline = self.deadline if deadline is None else deadline
+        level, priority_deadline = scheduler.currentPriority()
+        request_id = next(self._requestIds)
+        future = worker.send(request_id, deadline, (request_id, channel, kind, name, tuple(args), kwargs or {}, level, priority_deadline))
+        return future.result()
+
+    # -- private methods --
+
+    def _supervise(self):
+        while not self._stopped.wait(self.poll_interval):
+            now = time.monotonic()
+            for worker in self._workers:
+                if worker.expired(now):
+                    self._restart(worker, timed_out=True)
+                elif worker.started and not worker.alive:
+                    self._restart(worker)
+                elif worker.retry_at is not None and now >= worker.retry_at:
+                    with self._lock:
+                        if not worker.alive and not self._stopped.is_set():
+                            worker.start()
+
+    def _restart(self, worker, timed_out = False):
+        #A worker that was ready is started again at once, one that failed to start after a delay
+        with self._lock:
+            self.restarts[worker.name] += 1
+            worker.stop(timed_out)
+            if self._stopped.is_set():
+                return
+            if worker.failed_starts:
+                worker.retry_at = time.monotonic() + min(self.poll_interval * 2**(worker.failed_starts-1), self.max_backoff)
+            else:
+                worker.start()
+
+
+class _Worker():
+    #Parent side of one worker process: the process, its pipe and its outstanding requests
+
+    def __init__(self, group, slots = None):
+        self.group = group
+        self.slots = slots
+        self.name = min(group)
+        self.process = None
+        self.started = False
+        self.ready = False
+        self.failed_starts = 0      # exits before being ready since the last successful start
+        self.start_error = None     # why the last start failed
+        self.retry_at = None        # monotonic time of the next start after a failed one
+        self._conn = None
+        self._pending = {}  # request id -> (future, expires, name, deadline)
+        self._lock = threading.Lock()
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def start(self):
+        self.ready = False
+        self.retry_at = None
+        parent, child = _context.Pipe()
+        self.process = _context.Process(target=_serve, args=(child, self.group, self.slots), name=f"scint-worker-{self.name}", daemon=True)
+        self.process.start()
+        child.close()
+        self._conn = parent
+        self.started = True
+        threading.Thread(target=self._receive, args=(parent,), name=f"scint-worker-{self.name}-replies", daemon=True).start()
+
+    def stop(self, timed_out = False):
+        #Stops the process; outstanding requests fail with WorkerTimeout if timed_out, else WorkerDied
+        #or, if it never got ready, WorkerStartFailed
+        with self._lock:
+            process, conn, pending = self.process, self._conn, self._pending
+            self.process, self._conn, self._pending = None, None, {}
+            self.started = False
+        if process is not None:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+            process.join(0 if timed_out else .5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+            conn.close()
+            if not self.ready:
+                self.failed_starts += 1
+                if self.start_error is None:
+                    self.start_error = f"exited with code {process.exitcode} before it was ready"
+        for future, expires, name, deadline in pending.values():
+            if not self.ready:
+                future.set_exception(WorkerStartFailed(self.name, self.start_error))
+            elif timed_out and expires is not None:
+                future.set_exception(WorkerTimeout(self.name, name, deadline))
+            else:
+                future.set_exception(WorkerDied(self.name, name))
+
+    def send(self, request_id, deadline, request):
+        #Sends a request and returns the Future of its result
+        future = Future()
+        expires = None if deadline is None else time.monotonic() + deadline
+        with self._lock:
+            if self._conn is None:
+                raise WorkerDied(self.name, request[3])
+            self._pending[request_id] = (future, expires, request[3], deadline)
+            self._conn.send(request)
+        return future
+
+    def backingOff(self, now):
+        #Whether the worker failed to start and is waiting for its next start
+        return self.retry_at is not None and now < self.retry_at
+
+    def expired(self, now):
+        with self._lock:
+            return any(expires is not None and now > expires for _, expires, _, _ in self._pending.values())
+
+    def _receive(self, conn):
+        while(True):
+            try:
+                request_id, ok, payload = conn.recv()
+            except (EOFError, OSError):
+                return
+            if request_id is None:
+                #the worker's startup report
+                if ok:
+                    self.ready, self.failed_starts, self.start_error = True, 0, None
+                else:
+                    self.start_error = payload
+                continue
+            with self._lock:
+                future = self._pending.pop(request_id, (None,))[0]
+            if future is None:
+                continue
+            if ok:
+                future.set_result(payload)
+            else:
+                future.set_exception(payload)
+
+
+def _serve(conn, group, slots):
+    #Worker process: runs the requests for its channels in threads and sends back the results.
+    #Reports (None, True, None) once its channels are set up, or (None, False, error) and exits.
+    #Its channels share the given number of serial command slots, created here so they go away with the process.
+    hubSlot = threading.BoundedSemaphore(slots) if slots else None
+    try:
+        scints = {channel: Scintillator(scint_number=channel, hub_slot=hubSlot, **kwargs) for channel, kwargs in group.items()}
+    except Exception as e:
+        conn.send((None, False, f"{type(e).__name__}: {e}"))
+        return
+    conn.send((None, True, None))
+    sendLock = threading.Lock()
+
+    def handle(request_id, channel, kind, name, args, kwargs, level, deadline):
+        try:
+            with scheduler.priority(level, deadline):
+                if kind == "call":
+                    reply = (request_id, True, getattr(scints[channel], name)(*args, **kwargs))
+                elif kind == "get":
+                    reply = (request_id, True, getattr(scints[channel], name))
+                else:
+                    setattr(scints[channel], name, *args)
+                    reply = (request_id, True, None)
+        except Exception as e:
+            reply = (request_id, False, e)
+        try:
+            pickle.loads(pickle.dumps(reply[2]))
+        except Exception as e:
+            reply = (request_id, False, WorkerError(f"{name} returned {type(reply[2]).__name__}, which cannot be sent back: {e}"))
+        with sendLock:
+            conn.send(reply)
+
+    with ThreadPoolExecutor(max_workers=4*len(scints), thread_name_prefix="scint") as executor:
+        while(True):
+            try:
+                request = conn.recv()
+            except (EOFError, OSError):
+                break
+            if request is None:
+                break
+            executor.submit(handle, *request)
+    for scint in scints.values():
+        scint.close()